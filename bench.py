@@ -0,0 +1,367 @@
+"""Офлайн-бенчмарки горячих путей bot.py.
+
+Сеть не нужна: Telegram заменен фейковым ботом с настраиваемой задержкой,
+погода отдается локальным stub-сервером, база создается во временной папке.
+
+    python bench.py                          # JSON в stdout
+    python bench.py --output bench_output.txt
+    python bench.py --chats 10,1000 --latency 0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from itertools import count
+from types import SimpleNamespace
+
+from aiohttp import web
+
+
+class FakeBot:
+    """Бот, который ничего не отправляет, а только записывает вызовы"""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.file_ids = count(1)
+
+    def reset(self):
+        self.calls.clear()
+
+    async def _call(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call('send_message')
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        await self._call('send_photo')
+        file_id = photo if isinstance(photo, str) else f"fake-file-{next(self.file_ids)}"
+        return SimpleNamespace(chat_id=chat_id, photo=[SimpleNamespace(file_id=file_id)])
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self._call('send_media_group')
+        return [SimpleNamespace(chat_id=chat_id) for _ in media]
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text)
+
+    async def reply_photo(self, photo, **kwargs):
+        return await self.bot.send_photo(self.chat_id, photo)
+
+    async def reply_media_group(self, media, **kwargs):
+        return await self.bot.send_media_group(self.chat_id, media)
+
+
+def fake_update(bot: FakeBot, user_id: int = 1, chat_id: int = 1):
+    return SimpleNamespace(
+        message=FakeMessage(bot, chat_id),
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=chat_id)
+    )
+
+
+def fake_context(bot: FakeBot, args=None):
+    return SimpleNamespace(bot=bot, args=list(args or []))
+
+
+async def start_weather_stub():
+    """Локальная замена Visual Crossing: тот же формат ответа, без сети"""
+    async def timeline(request):
+        return web.json_response({'currentConditions': {'temp': 12.5, 'conditions': 'Partially cloudy'}})
+
+    app = web.Application()
+    app.router.add_get('/timeline/{city}/today', timeline)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/timeline"
+
+
+def summarize(samples, operations: int = 1, **extra):
+    """Сводка по замерам в секундах: среднее, перцентили и операций в секунду"""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    result = {
+        'iterations': len(ordered),
+        'total_s': round(total, 6),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 4),
+        'p50_ms': round(ordered[len(ordered) // 2] * 1000, 4),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 4),
+        'ops_per_s': round(operations * len(ordered) / total, 1) if total > 0 else None,
+    }
+    result.update(extra)
+    return result
+
+
+async def measure(func, iterations: int, before=None):
+    samples = []
+    for _ in range(iterations):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def fill_chats(bot_module, size: int, first_id: int = 1_000_000):
+    """Перезаполнение таблицы chats ровно size чатами"""
+    registry = bot_module.chat_registry
+    bot_module.persistence.flush_sync()
+    with registry.conn:
+        registry.conn.execute("DELETE FROM chats")
+        registry.conn.executemany(
+            "INSERT INTO chats (chat_id, added_at) VALUES (?, ?)",
+            ((chat_id, 0.0) for chat_id in range(first_id, first_id + size))
+        )
+    registry.chat_ids = set(range(first_id, first_id + size))
+
+
+def reset_outbox(bot_module):
+    """Каждый прогон рассылки - новая запись в журнале доставки"""
+    with bot_module.database:
+        bot_module.database.execute("DELETE FROM outbox")
+        bot_module.database.execute("DELETE FROM outbox_messages")
+
+
+async def bench_broadcasts(bot_module, fake_bot: FakeBot, sizes, repeat: int):
+    application = SimpleNamespace(bot=fake_bot)
+    class_schedule = bot_module.schedules.get()
+    lesson = class_schedule.timetable.lessons[0]
+    # Часы бота переводятся на неделю вперед, чтобы рассылки не считались просроченными
+    real_now = bot_module.moscow_now
+    week_ahead = real_now() + timedelta(days=7)
+    morning_at = week_ahead.replace(hour=bot_module.MORNING_TIME[0], minute=bot_module.MORNING_TIME[1])
+    hours, minutes = divmod(lesson.start % bot_module.MINUTES_PER_DAY - bot_module.REMINDER_MINUTES, 60)
+    reminder_at = week_ahead.replace(hour=hours, minute=minutes)
+    results = {}
+    for size in sizes:
+        fill_chats(bot_module, size)
+        for name, clock, run in (
+            ('morning_broadcast', morning_at, lambda: bot_module.send_morning_broadcast(application)),
+            ('lesson_reminder', reminder_at, lambda: bot_module.send_lesson_reminder(application, class_schedule, lesson)),
+        ):
+            fake_bot.reset()
+            bot_module.moscow_now = lambda: clock
+            try:
+                samples = await measure(run, repeat, lambda: reset_outbox(bot_module))
+            finally:
+                bot_module.moscow_now = real_now
+            report = bot_module.broadcaster.last_report
+            results[f"{name}[{size}]"] = summarize(
+                samples, operations=size,
+                sent=report.sent, failed=report.failed, calls=dict(fake_bot.calls)
+            )
+    return results
+
+
+async def bench_renders(bot_module, fake_bot: FakeBot, iterations: int):
+    update = fake_update(fake_bot)
+    queries = ['алгебра', 'физ', 'истрия', 'ществ', 'химия']
+    handlers = {
+        'week_schedule': lambda: bot_module.week_schedule(update, fake_context(fake_bot)),
+        'stats': lambda: bot_module.stats(update, fake_context(fake_bot)),
+        'find_subject': lambda: asyncio.gather(*(
+            bot_module.find_subject(update, fake_context(fake_bot, [query])) for query in queries
+        )),
+    }
+
+    def invalidate():
+        bot_module.schedules.get().render_cache = bot_module.RenderCache()
+
+    results = {}
+    for name, handler in handlers.items():
+        operations = len(queries) if name == 'find_subject' else 1
+        results[f"{name}[cold]"] = summarize(await measure(handler, iterations, invalidate), operations)
+        results[f"{name}[cached]"] = summarize(await measure(handler, iterations), operations)
+    return results
+
+
+async def bench_get_answer(bot_module, fake_bot: FakeBot, photos: int, texts: int, iterations: int):
+    store = bot_module.answers_store
+    subject = 'Бенчмарк большой предмет'
+    answers = [{'type': 'photo', 'content': f"photo-{i}"} for i in range(photos)]
+    answers += [{'type': 'text', 'content': f"Ответ {i}. " + 'текст ' * 900} for i in range(texts)]
+    store.put(subject, answers)
+    await bot_module.persistence.flush()
+
+    update = fake_update(fake_bot)
+    context = fake_context(fake_bot, subject.split())
+    results = {}
+    for name, before in (('cold', lambda: store.loaded.pop(subject, None)), ('cached', None)):
+        fake_bot.reset()
+        samples = await measure(lambda: bot_module.get_answer(update, context), iterations, before)
+        results[f"get_answer[{name}]"] = summarize(
+            samples, items=len(answers), calls={k: v // iterations for k, v in fake_bot.calls.items()}
+        )
+    store.delete(subject)
+    await bot_module.persistence.flush()
+    return results
+
+
+async def bench_persistence(bot_module, chats: int, subjects: int, answers_per_subject: int):
+    """Стоимость вызова в обработчике и отдельно фоновой записи накопленных изменений"""
+    persistence = bot_module.persistence
+    fill_chats(bot_module, 0)
+    new_ids = range(5_000_000, 5_000_000 + chats)
+
+    started = time.perf_counter()
+    for chat_id in new_ids:
+        bot_module.add_chat(chat_id)
+    new_elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    await persistence.flush()
+    chats_flush_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for chat_id in new_ids:
+        bot_module.add_chat(chat_id)
+    known_elapsed = time.perf_counter() - started
+
+    answers = [{'type': 'text', 'content': f"Ответ {i}"} for i in range(answers_per_subject)]
+    samples = []
+    for i in range(subjects):
+        started = time.perf_counter()
+        bot_module.answers_store.put(f"Предмет {i}", answers)
+        samples.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    await persistence.flush()
+    answers_flush_elapsed = time.perf_counter() - started
+    for i in range(subjects):
+        bot_module.answers_store.delete(f"Предмет {i}")
+    await persistence.flush()
+
+    return {
+        'add_chat[new]': summarize([new_elapsed], operations=chats),
+        'add_chat[known]': summarize([known_elapsed], operations=chats),
+        'add_chat[flush]': summarize([chats_flush_elapsed], operations=chats),
+        'save_answers': summarize(samples, items=answers_per_subject),
+        'save_answers[flush]': summarize([answers_flush_elapsed], operations=subjects, items=answers_per_subject),
+    }
+
+
+async def bench_homework(bot_module, fake_bot: FakeBot, items: int, iterations: int):
+    store = bot_module.homework_store
+    update = fake_update(fake_bot)
+    today = bot_module.moscow_now().date()
+    for i in range(items):
+        day = (today + timedelta(days=i % (bot_module.HOMEWORK_DAYS_AHEAD + 1))).isoformat()
+        store.put(day, f"Предмет {i}", f"Параграф {i}, упражнения {i}-{i + 5}")
+    await bot_module.persistence.flush()
+
+    return {
+        'homework': summarize(await measure(lambda: bot_module.homework(update, fake_context(fake_bot)), iterations)),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+async def run(args):
+    weather_runner, weather_url = await start_weather_stub()
+    # Импорт после настройки окружения: база и кэш file_id создаются при импорте
+    import bot as bot_module
+
+    bot_module.WEATHER_API_URL = weather_url
+    bot_module.weather_service.ttl = 0
+    bot_module.broadcaster = bot_module.Broadcaster(
+        rate=args.rate or 1e9, concurrency=bot_module.BROADCAST_CONCURRENCY, chat_interval=0
+    )
+    bot_module.answers_store.load()
+    bot_module.image_catalog.refresh()
+    fake_bot = FakeBot(args.latency / 1000)
+    # Команды меряются без сетевой задержки: интересна только стоимость самого кода
+    instant_bot = FakeBot()
+
+    results = {}
+    try:
+        results.update(await bench_broadcasts(bot_module, fake_bot, args.chats, args.repeat))
+        results.update(await bench_renders(bot_module, instant_bot, args.iterations))
+        results.update(await bench_get_answer(bot_module, instant_bot, args.photos, args.texts, args.repeat))
+        results.update(await bench_persistence(bot_module, args.persist_chats, args.subjects, args.answers))
+        results.update(await bench_homework(bot_module, instant_bot, args.homework, args.iterations))
+    finally:
+        await bot_module.weather_service.close()
+        await weather_runner.cleanup()
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': {
+            'latency_ms': args.latency,
+            'rate': args.rate,
+            'concurrency': bot_module.BROADCAST_CONCURRENCY,
+        },
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки bot.py")
+    parser.add_argument('--chats', default='10,1000,10000',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help="размеры рассылок через запятую")
+    parser.add_argument('--latency', type=float, default=5.0, help="задержка фейкового Telegram в рассылках, мс")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="лимит сообщений в секунду (0 — без лимита, измеряется сам код)")
+    parser.add_argument('--repeat', type=int, default=3, help="повторы рассылок и get_answer")
+    parser.add_argument('--iterations', type=int, default=200, help="повторы команд рендеринга")
+    parser.add_argument('--photos', type=int, default=500, help="фото в большом предмете")
+    parser.add_argument('--texts', type=int, default=50, help="длинных текстов в большом предмете")
+    parser.add_argument('--persist-chats', type=int, default=10000, help="чатов для add_chat")
+    parser.add_argument('--subjects', type=int, default=200, help="предметов для save_answers")
+    parser.add_argument('--answers', type=int, default=50, help="ответов в каждом предмете")
+    parser.add_argument('--homework', type=int, default=300, help="заданий для /homework")
+    parser.add_argument('--output', help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument('--verbose', action='store_true', help="не отключать логи бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        os.environ['DATABASE_FILE'] = os.path.join(workdir, 'bench.db')
+        os.environ['IMAGE_FILE_IDS_FILE'] = os.path.join(workdir, 'image_file_ids.json')
+        os.environ['SCHEDULES_DIR'] = workdir
+        os.environ.setdefault('WEATHER_API_KEY', 'bench')
+        result = asyncio.run(run(args))
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
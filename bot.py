@@ -1,40 +1,169 @@
+import time
+# Отсчет времени запуска: до тяжелых импортов, чтобы они вошли в замер
+STARTUP_STARTED = time.perf_counter()
 import os
 import random
 import logging
-import aiohttp
+import asyncio
+import re
 from datetime import datetime, timedelta
 import pytz
 from pathlib import Path
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Bot, InlineQueryResultArticle, InputMediaPhoto, InputTextMessageContent, Update
 from telegram.ext import (
     Application, 
+    BaseUpdateProcessor,
     CommandHandler, 
+    InlineQueryHandler,
     ContextTypes,
+    ApplicationHandlerStop,
     MessageHandler,
+    TypeHandler,
     filters
 )
-from telegram.error import TimedOut, NetworkError, RetryAfter
+from telegram.error import TimedOut, NetworkError, RetryAfter, BadRequest
+from telegram.request import HTTPXRequest
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-import time
 import httpx
 import signal
 import sys
 import json
-from typing import Dict, List, Union
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict
+import fcntl
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
-DNEVNIK_LOGIN = os.getenv('DNEVNIK_LOGIN')
-DNEVNIK_PASSWORD = os.getenv('DNEVNIK_PASSWORD')
+WEATHER_API_URL = os.getenv(
+    'WEATHER_API_URL',
+    'https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline'
+)
+HOMEWORK_DAYS_AHEAD = 14
+HOMEWORK_KEEP_DAYS = 30
 ADMIN_IDS = [1048782601]  
+UPLOAD_SESSION_TTL = float(os.getenv('UPLOAD_SESSION_TTL', '3600'))
+UPLOAD_MAX_ITEMS = int(os.getenv('UPLOAD_MAX_ITEMS', '200'))
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'bot.db')
+PERSIST_DELAY = float(os.getenv('PERSIST_DELAY', '0.3'))
+PERSIST_RETRY_DELAY = 5.0
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+THROTTLE_USER_RATE = float(os.getenv('THROTTLE_USER_RATE', '0.5'))
+THROTTLE_USER_BURST = int(os.getenv('THROTTLE_USER_BURST', '5'))
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '10'))
+READ_ONLY_COMMANDS = {'schedule', 'week', 'next', 'current', 'break', 'stats', 'find', 'homework'}
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+MAX_MESSAGE_LENGTH = 4096
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '3600'))
+INLINE_LIVE_CACHE_TIME = 60
+INLINE_MAX_RESULTS = 50
+MEDIA_GROUP_SIZE = 10
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '30'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '30'))
+BROADCAST_CHAT_INTERVAL = float(os.getenv('BROADCAST_CHAT_INTERVAL', '1'))
+BROADCAST_MAX_ATTEMPTS = 5
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '1'))
+OUTBOX_MAX_ATTEMPTS = 3
+OUTBOX_RETRY_DELAY = 30
+OUTBOX_KEEP_DAYS = 7
+LOCK_FILE = "bot.lock"
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', '600'))
+WEATHER_CITIES = ("Moscow", "Podolsk")
+SCHEDULES_DIR = Path(os.getenv('SCHEDULES_DIR', 'schedules'))
+DEFAULT_CLASS = os.getenv('DEFAULT_CLASS', 'default')
+SCHEDULE_CHECK_INTERVAL = 5
+IMAGES_DIR = Path('images')
+OPTIMIZED_IMAGES_DIR = Path('images_optimized')
+IMAGE_MAX_SIDE = 1280
+IMAGE_QUALITY = 80
+EXIF_ORIENTATION = 0x0112
+IMAGE_DUPLICATE_DISTANCE = 4
+IMAGE_FILE_IDS_FILE = os.getenv('IMAGE_FILE_IDS_FILE', 'image_file_ids.json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_DEBUG_SAMPLE = max(1, int(os.getenv('LOG_DEBUG_SAMPLE', '20')))
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись журнала - одна строка JSON; поля из extra попадают в объект"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'handler': record.funcName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DebugSampler(logging.Filter):
+    """Из отладочных записей пропускается каждая N-я, отдельно для каждого обработчика"""
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.counters = defaultdict(int)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        key = (record.name, record.funcName)
+        self.counters[key] += 1
+        return self.counters[key] % self.every == 1
+
+class LazyQueueHandler(QueueHandler):
+    """Запись уходит в очередь без форматирования: его выполняет поток слушателя.
+    Отладочные дампы форматируются сразу, пока изменяемые аргументы не поменялись."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.levelno <= logging.DEBUG:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+log_listener = None
+
+def setup_logging():
+    """Журнал через очередь: обработчики только кладут записи, вывод идет в отдельном потоке"""
+    global log_listener
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(LOG_TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к Telegram API
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    log_listener = QueueListener(log_queue, output)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+setup_logging()
 
 schedule_dict = {
     'Monday': [
@@ -112,77 +241,1498 @@ motivational_quotes = [
     "Дорогу осилит идущий."
 ]
 
-answers_dict: Dict[str, List[Union[str, str]]] = {}
-ANSWERS_FILE = "answers.json"
-global adding_answers_states
-adding_answers_states = {}
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+LESSON_DURATION = 45
+REMINDER_MINUTES = 10
+MORNING_TIME = (7, 30)
+MORNING_GRACE_MINUTES = 120
 
-CHATS_FILE = "chats.json"
-CHATS_SET = set()  
+class Lesson(NamedTuple):
+    day: str
+    number: int
+    time: str
+    subject: str
+    start: int
+    end: int
 
-def load_chats():
-    """Загрузка списка чатов из файла"""
-    try:
-        global CHATS_SET
-        if os.path.exists(CHATS_FILE):
-            with open(CHATS_FILE, 'r', encoding='utf-8') as f:
-                chats = json.load(f)
-                CHATS_SET = set(chats)
-                logger.info(f"Загружены чаты: {CHATS_SET}")
-        return CHATS_SET
-    except Exception as e:
-        logger.error(f"❌ Ошибка при загрузке списка чатов: {e}")
-        return CHATS_SET
+def minute_of_week(moment: datetime) -> int:
+    return moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
 
-def save_chats(chats):
-    """Сохранение списка чатов в файл"""
-    try:
-        global CHATS_SET
-        CHATS_SET = chats
-        with open(CHATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(list(chats), f)
-        logger.info(f"Сохранены чаты: {CHATS_SET}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка при сохранении списка чатов: {e}")
+def moscow_now() -> datetime:
+    return datetime.now(MOSCOW_TZ)
+
+SUBJECT_MATCH_SCORE = 0.6
+SUBJECT_SUGGEST_SCORE = 0.3
+SUBJECT_MIN_PREFIX = 3
+
+def normalize_subject(text: str) -> str:
+    """Приведение названия к виду для поиска: регистр, ё→е, пробелы"""
+    return ' '.join(re.findall(r'\w+', text.casefold().replace('ё', 'е')))
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SubjectIndex:
+    """Индекс названий предметов: инвертированный индекс токенов и триграммное сходство"""
+    def __init__(self, names):
+        self.names = list(dict.fromkeys(names))
+        self.positions = {name: position for position, name in enumerate(self.names)}
+        self.normalized = {name: normalize_subject(name) for name in self.names}
+        self.exact = {}
+        self.prefixes = defaultdict(set)
+        self.trigram_index = defaultdict(set)
+        self.trigram_sets = {}
+        for name, normalized in self.normalized.items():
+            self.exact.setdefault(normalized, name)
+            for token in normalized.split():
+                for length in range(1, len(token) + 1):
+                    self.prefixes[token[:length]].add(name)
+            grams = trigrams(normalized)
+            self.trigram_sets[name] = grams
+            for gram in grams:
+                self.trigram_index[gram].add(name)
+
+    def search(self, query: str, limit: int = 5, min_score: float = SUBJECT_SUGGEST_SCORE) -> List[tuple]:
+        """Ранжированный список (название, оценка)"""
+        normalized = normalize_subject(query)
+        if not normalized:
+            return []
+        if normalized in self.exact:
+            return [(self.exact[normalized], 1.0)]
+
+        scores = defaultdict(float)
+        tokens = normalized.split()
+        for token in tokens:
+            # Короткий префикс ('а', 'ф') годится только для подсказки, но не для выбора предмета
+            weight = 0.9 if len(token) >= SUBJECT_MIN_PREFIX else SUBJECT_SUGGEST_SCORE
+            for name in self.prefixes.get(token, ()):
+                scores[name] += weight / len(tokens)
+        if not scores:
+            for name, name_normalized in self.normalized.items():
+                if normalized in name_normalized:
+                    scores[name] = 0.8
+
+        grams = trigrams(normalized)
+        overlaps = defaultdict(int)
+        for gram in grams:
+            for name in self.trigram_index.get(gram, ()):
+                overlaps[name] += 1
+        for name, overlap in overlaps.items():
+            similarity = overlap / len(grams | self.trigram_sets[name])
+            scores[name] = max(scores[name], similarity)
+
+        ranked = sorted(
+            ((name, score) for name, score in scores.items() if score >= min_score),
+            key=lambda item: (-item[1], self.positions[item[0]])
+        )
+        return ranked[:limit]
+
+    def resolve(self, query: str) -> Optional[str]:
+        """Однозначное совпадение (точное после нормализации или явный лидер поиска)"""
+        ranked = self.search(query, limit=2)
+        if not ranked or ranked[0][1] < SUBJECT_MATCH_SCORE:
+            return None
+        if len(ranked) > 1 and ranked[1][1] == ranked[0][1]:
+            return None
+        return ranked[0][0]
+
+    def suggestions(self, query: str) -> List[str]:
+        return [name for name, _ in self.search(query, limit=3)]
+
+class Timetable:
+    """Расписание, скомпилированное в таблицу на каждую минуту недели"""
+    def __init__(self, schedule: Dict[str, list], version: int = 0):
+        self.version = version
+        self.lessons = []
+        for day, lessons in schedule.items():
+            day_start = WEEKDAYS.index(day) * MINUTES_PER_DAY
+            for number, (time, subject) in enumerate(lessons, start=1):
+                hours, minutes = map(int, time.split(':'))
+                start = day_start + hours * 60 + minutes
+                self.lessons.append(Lesson(day, number, time, subject, start, start + LESSON_DURATION))
+        self.lessons.sort(key=lambda lesson: lesson.start)
+        self.by_start = {lesson.start: lesson for lesson in self.lessons}
+        self.subjects = SubjectIndex(lesson.subject for lesson in self.lessons)
+
+        # Для каждой минуты: текущий урок и следующий урок в тот же день
+        self.current_slots: List[Optional[Lesson]] = [None] * MINUTES_PER_WEEK
+        self.next_slots: List[Optional[Lesson]] = [None] * MINUTES_PER_WEEK
+        previous_start = 0
+        for lesson in self.lessons:
+            day_start = lesson.start - lesson.start % MINUTES_PER_DAY
+            for minute in range(max(previous_start, day_start), lesson.start):
+                self.next_slots[minute] = lesson
+            for minute in range(lesson.start, min(lesson.end, MINUTES_PER_WEEK)):
+                self.current_slots[minute] = lesson
+            previous_start = lesson.start
+
+    def current(self, moment: datetime) -> Optional[Lesson]:
+        return self.current_slots[minute_of_week(moment)]
+
+    def next(self, moment: datetime) -> Optional[Lesson]:
+        return self.next_slots[minute_of_week(moment)]
+
+    def current_break(self, moment: datetime) -> Optional[Lesson]:
+        """Следующий урок, если сейчас перемена между уроками"""
+        minute = minute_of_week(moment)
+        lesson = self.next_slots[minute]
+        if lesson is None or lesson.number == 1 or self.current_slots[minute] is not None:
+            return None
+        return lesson
+
+    def starting_at(self, moment: datetime) -> Optional[Lesson]:
+        return self.by_start.get(minute_of_week(moment))
+
+    @staticmethod
+    def seconds_until(minute: int, moment: datetime) -> int:
+        return (minute - minute_of_week(moment)) * 60 - moment.second
+
+class ClassSchedule:
+    """Расписание одного класса: исходные данные, скомпилированные индексы и кэш готовых ответов"""
+    def __init__(self, class_id: str, schedule: Dict[str, list], version: int, mtime: Optional[int] = None):
+        self.class_id = class_id
+        self.schedule = schedule
+        self.mtime = mtime
+        self.timetable = Timetable(schedule, version)
+        self.render_cache = RenderCache()
+
+def load_schedule_file(path: Path) -> Dict[str, list]:
+    """Файл расписания класса: {"Monday": [["8:30", "Алгебра"], ...], ...}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    schedule = {}
+    for day, lessons in data.items():
+        if day not in WEEKDAYS:
+            raise ValueError(f"неизвестный день недели {day!r}")
+        schedule[day] = [(str(time), str(subject)) for time, subject in lessons]
+    return schedule
+
+class ScheduleRegistry:
+    """Расписания классов из файлов <класс>.json с перезагрузкой по mtime.
+    Пока файла для класса по умолчанию нет, используется встроенное schedule_dict."""
+    def __init__(self, directory: Path, builtin: Dict[str, list]):
+        self.directory = directory
+        self.builtin = builtin
+        self.classes: Dict[str, ClassSchedule] = {}
+        self.version = 0
+        self.checked = None
+
+    def refresh(self, force: bool = False) -> bool:
+        """Перечитывает измененные файлы не чаще раза в SCHEDULE_CHECK_INTERVAL секунд"""
+        now = time.monotonic()
+        if not force and self.checked is not None and now - self.checked < SCHEDULE_CHECK_INTERVAL:
+            return False
+        self.checked = now
+
+        classes, changed = {}, False
+        for path in self.directory.glob('*.json'):
+            class_id = path.stem
+            current = self.classes.get(class_id)
+            try:
+                mtime = path.stat().st_mtime_ns
+                if current is not None and current.mtime == mtime:
+                    classes[class_id] = current
+                    continue
+                classes[class_id] = ClassSchedule(class_id, load_schedule_file(path), self.version + 1, mtime)
+                changed = True
+                logger.info("Загружено расписание класса %s", class_id)
+            except Exception as e:
+                logger.error("❌ Ошибка в файле расписания %s: %s", path, e)
+                if current is not None:
+                    classes[class_id] = current
+
+        if DEFAULT_CLASS not in classes:
+            current = self.classes.get(DEFAULT_CLASS)
+            if current is None or current.schedule is not self.builtin:
+                current = ClassSchedule(DEFAULT_CLASS, self.builtin, self.version + 1)
+                changed = True
+            classes[DEFAULT_CLASS] = current
+
+        if not changed and classes.keys() == self.classes.keys():
+            return False
+        self.classes = classes
+        self.version += 1
+        if reminder_scheduler is not None:
+            reminder_scheduler.sync(self)
+        return True
+
+    def get(self, class_id: str = DEFAULT_CLASS) -> ClassSchedule:
+        self.refresh()
+        return self.classes.get(class_id) or self.classes[DEFAULT_CLASS]
+
+    def for_chat(self, chat_id: int) -> ClassSchedule:
+        return self.get(chat_registry.class_of(chat_id))
+
+    def all(self) -> List[ClassSchedule]:
+        self.refresh()
+        return list(self.classes.values())
+
+    def find(self, name: str) -> Optional[str]:
+        """Класс по названию без учета регистра"""
+        self.refresh()
+        return {class_id.lower(): class_id for class_id in self.classes}.get(name.strip().lower())
+
+schedules = ScheduleRegistry(SCHEDULES_DIR, schedule_dict)
+
+async def refresh_schedules() -> None:
+    """Задача планировщика: реестр и напоминания меняются только в цикле событий"""
+    schedules.refresh()
+
+def format_duration(seconds: int) -> str:
+    hours, remainder = divmod(max(seconds, 0), 3600)
+    return f"{hours} ч. {remainder // 60} мин."
+
+LEGACY_ANSWERS_FILE = "answers.json"
+
+LEGACY_CHATS_FILE = "chats.json"
+LEGACY_CHAT_IDS_FILE = "chat_ids.txt"
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        target, total = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Счетчики и гистограммы в памяти с выводом в формате Prometheus"""
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            total = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                total += count
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {total}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def histogram_rows(self, name: str) -> List[tuple]:
+        """(метки, histogram) для одной метрики, по убыванию суммарного времени"""
+        rows = [(dict(labels), histogram) for (key, labels), histogram in self.histograms.items() if key == name]
+        return sorted(rows, key=lambda row: row[1].sum, reverse=True)
+
+    def counter_rows(self, name: str) -> List[tuple]:
+        rows = [(dict(labels), value) for (key, labels), value in self.counters.items() if key == name]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+metrics = Metrics()
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest со счетчиками вызовов Telegram API по методам"""
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc('telegram_api_errors_total', method=api_method)
+            raise
+        finally:
+            metrics.inc('telegram_api_requests_total', method=api_method)
+            metrics.observe('telegram_api_seconds', time.perf_counter() - started, method=api_method)
+        if status >= 400:
+            metrics.inc('telegram_api_errors_total', method=api_method)
+        return status, payload
+
+class StartupTimer:
+    """Замеры фаз запуска: от старта процесса до готовности принимать обновления и первого ответа"""
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        self.phases = []
+        self.answered = False
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        metrics.set('startup_phase_seconds', now - self.last, phase=phase)
+        self.last = now
+
+    def report(self):
+        logger.info(
+            "🚀 Готов к приему обновлений через %.0f мс после запуска: %s",
+            (self.last - self.started) * 1000,
+            ', '.join(f"{phase} {seconds * 1000:.0f} мс" for phase, seconds in self.phases)
+        )
+
+    def first_update(self):
+        if not self.answered:
+            self.answered = True
+            logger.info("Первое обновление обработано через %.0f мс после запуска",
+                        (time.perf_counter() - self.started) * 1000)
+
+startup_timer = StartupTimer(STARTUP_STARTED)
+
+class StoreLoader:
+    """Фоновая загрузка хранилищ после старта бота: обработчики ждут только те хранилища, что им нужны"""
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Future] = {}
+
+    def start(self, name: str, load, apply=None):
+        """load() выполняется в отдельном потоке и не задерживает обработку обновлений;
+        apply() затем вызывается в цикле событий (там, где можно помечать данные для записи)"""
+        self.tasks[name] = asyncio.ensure_future(self._run(name, load, apply))
+
+    async def _run(self, name: str, load, apply):
+        started = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, load)
+            if apply is not None:
+                apply()
+        except Exception as e:
+            logger.error("❌ Ошибка фоновой загрузки %s: %s", name, e)
+        seconds = time.perf_counter() - started
+        metrics.set('store_load_seconds', seconds, store=name)
+        logger.info("Фоновая загрузка %s: %.0f мс", name, seconds * 1000)
+
+    async def wait(self, *names: str):
+        """До окончания загрузки; если загрузка не запускалась (тесты, бенчмарки), сразу"""
+        for name in names:
+            task = self.tasks.get(name)
+            if task is not None and not task.done():
+                await asyncio.shield(task)
+
+store_loader = StoreLoader()
+
+COMMAND_STORES = {
+    'add_answer': ('answers', 'uploads'),
+    'get_answer': ('answers',),
+    'list_answer': ('answers',),
+    'del_answer': ('answers',),
+    'done': ('answers', 'uploads'),
+    'homework': ('homework',),
+    'homework_add': ('homework',),
+    'homework_del': ('homework',),
+    'test_morning': ('images',),
+}
+
+def import_aiohttp():
+    import aiohttp.web
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных чатов обрабатываются параллельно (не больше max_concurrent сразу),
+    обновления одного чата и одного пользователя - строго в порядке поступления"""
+    def __init__(self, max_concurrent: int):
+        # Семафор базового класса берется с запасом: обновление, которое ждет своей очереди
+        # в чате, не должно занимать слот обработки. Настоящий лимит - self.semaphore
+        super().__init__(2 ** 16)
+        self.max_concurrent = max_concurrent
+        self.semaphore = None
+        self.tails = {}
+        self.waiting = 0
+        self.active = 0
+
+    @staticmethod
+    def _keys(update: object) -> List[tuple]:
+        """Очереди, в которых стоит обновление: его чат и его пользователь"""
+        if not isinstance(update, Update):
+            return []
+        keys = []
+        if update.effective_chat is not None:
+            keys.append(('chat', update.effective_chat.id))
+        if update.effective_user is not None:
+            keys.append(('user', update.effective_user.id))
+        return keys
+
+    def _report(self):
+        metrics.set('update_queue_depth', self.waiting)
+        metrics.set('updates_in_progress', self.active)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        started = time.perf_counter()
+        keys = self._keys(update)
+        # Очередь занимается сразу при поступлении: обновление ждет завершения предыдущих
+        # обновлений своего чата и своего пользователя, и никто не может обогнать его по одной из них
+        previous = {self.tails[key] for key in keys if key in self.tails}
+        done = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self.tails[key] = done
+        running = False
+        self.waiting += 1
+        self._report()
+        try:
+            if previous:
+                await asyncio.wait(previous)
+            async with self.semaphore:
+                running = True
+                self.waiting -= 1
+                self.active += 1
+                metrics.observe('update_wait_seconds', time.perf_counter() - started)
+                self._report()
+                try:
+                    await coroutine
+                    startup_timer.first_update()
+                finally:
+                    self.active -= 1
+        finally:
+            if not running:
+                self.waiting -= 1
+                if asyncio.iscoroutine(coroutine):
+                    coroutine.close()
+            self._report()
+            # Отмененное в очереди обновление освобождает ее только после своих предшественников
+            pending = [future for future in previous if not future.done()]
+            if pending:
+                asyncio.ensure_future(asyncio.wait(pending)).add_done_callback(lambda _: self._finish(keys, done))
+            else:
+                self._finish(keys, done)
+
+    def _finish(self, keys: List[tuple], done: asyncio.Future):
+        done.set_result(None)
+        for key in keys:
+            if self.tails.get(key) is done:
+                del self.tails[key]
+
+    async def initialize(self) -> None:
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+
+    async def shutdown(self) -> None:
+        pass
+
+def timed_command(command: str, callback):
+    """Обертка обработчика команды: ожидание нужных ему хранилищ и замер времени выполнения"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with metrics.timer('bot_command_seconds', command=command):
+            await store_loader.wait(*COMMAND_STORES.get(command, ()))
+            return await callback(update, context)
+    wrapper.__name__ = callback.__name__
+    wrapper.__doc__ = callback.__doc__
+    return wrapper
+
+def connect_database(path: str) -> sqlite3.Connection:
+    """Подключение к SQLite в режиме WAL"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+class PersistenceWorker:
+    """Отложенная запись: обработчики только помечают данные измененными,
+    накопленные изменения пишутся раз в delay секунд в отдельном потоке"""
+    def __init__(self, database_file: str, delay: float):
+        self.database_file = database_file
+        self.delay = delay
+        self.dirty = {}
+        self.failed = []
+        self.conn = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='persistence', initializer=self._connect
+        )
+        self._flush_handle = None
+        self._flush_task = None
+        self.closed = False
+
+    def _connect(self):
+        self.conn = connect_database(self.database_file)
+
+    def mark_dirty(self, key: str, prepare):
+        """prepare() вызывается в цикле событий и возвращает функцию записи write(conn) или None.
+        Повторные пометки одного ключа до записи схлопываются в одну."""
+        self.dirty[key] = prepare
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        self._schedule(loop, self.delay)
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop, delay: float):
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _take_writes(self) -> list:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        writes, self.failed = self.failed, []
+        dirty, self.dirty = self.dirty, {}
+        for key, prepare in dirty.items():
+            write = prepare()
+            if write is not None:
+                writes.append((key, write))
+        return writes
+
+    def _write(self, writes: list) -> list:
+        """Выполняется в потоке записи; возвращает неудавшиеся записи"""
+        failed = []
+        for key, write in writes:
+            try:
+                with metrics.timer('persistence_write_seconds', store=key.split(':')[0]):
+                    write(self.conn)
+            except Exception as e:
+                logger.error("❌ Ошибка при записи %s: %s", key, e)
+                failed.append((key, write))
+        return failed
+
+    async def flush(self):
+        """Запись всех накопленных изменений; заодно дожидается уже начатых записей"""
+        loop = asyncio.get_running_loop()
+        failed = await loop.run_in_executor(self.executor, self._write, self._take_writes())
+        if failed:
+            metrics.inc('persistence_errors_total', len(failed))
+            self.failed = failed + self.failed
+            self._schedule(loop, PERSIST_RETRY_DELAY)
+
+    def flush_sync(self):
+        """Синхронная запись, когда цикл событий не работает: при загрузке и завершении"""
+        failed = self.executor.submit(self._write, self._take_writes()).result()
+        self.failed = failed + self.failed
+
+    async def call(self, func):
+        """Выполнение func(conn) в потоке записи, по очереди с остальными записями"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(self.conn))
+
+    def close(self):
+        """Последняя запись и остановка потока; повторный вызов ничего не делает"""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush_sync()
+        self.executor.shutdown(wait=True)
+
+class ChatRegistry:
+    """Единый реестр чатов: множество в памяти и таблица chats в SQLite"""
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.chat_ids = set()
+        self.classes: Dict[int, str] = {}
+        self.pending = []
+        self.class_updates = {}
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, added_at REAL NOT NULL, class_id TEXT)"
+            )
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(chats)")}
+            if 'class_id' not in columns:
+                self.conn.execute("ALTER TABLE chats ADD COLUMN class_id TEXT")
+
+    def load(self):
+        """Загрузка чатов из базы (и однократный перенос из старых файлов)"""
+        try:
+            rows = self.conn.execute("SELECT chat_id, class_id FROM chats").fetchall()
+            self.chat_ids = {chat_id for chat_id, _ in rows}
+            self.classes = {chat_id: class_id for chat_id, class_id in rows if class_id is not None}
+            if not self.chat_ids:
+                self._import_legacy_files()
+            logger.info("Загружено чатов: %d", len(self.chat_ids))
+        except Exception as e:
+            logger.error("❌ Ошибка при загрузке списка чатов: %s", e)
+
+    def _import_legacy_files(self):
+        legacy = set()
+        if os.path.exists(LEGACY_CHATS_FILE):
+            with open(LEGACY_CHATS_FILE, 'r', encoding='utf-8') as f:
+                legacy.update(json.load(f))
+        if os.path.exists(LEGACY_CHAT_IDS_FILE):
+            with open(LEGACY_CHAT_IDS_FILE, 'r') as f:
+                legacy.update(int(line.strip()) for line in f if line.strip())
+        if legacy:
+            now = time.time()
+            self.chat_ids.update(legacy)
+            self.pending.extend((chat_id, now) for chat_id in legacy)
+            persistence.mark_dirty('chats', self._prepare_write)
+            logger.info("Перенесено чатов из старых файлов: %d", len(legacy))
+
+    def add(self, chat_id: int):
+        """Добавление чата; повторные вызовы для известного чата ничего не стоят"""
+        if chat_id in self.chat_ids:
+            return
+        self.chat_ids.add(chat_id)
+        self.pending.append((chat_id, time.time()))
+        logger.info("Добавлен чат %s. Всего чатов: %d", chat_id, len(self.chat_ids))
+        persistence.mark_dirty('chats', self._prepare_write)
+
+    def class_of(self, chat_id: int) -> str:
+        return self.classes.get(chat_id, DEFAULT_CLASS)
+
+    def set_class(self, chat_id: int, class_id: str):
+        """Привязка чата к классу; NULL в базе означает класс по умолчанию"""
+        self.add(chat_id)
+        if class_id == DEFAULT_CLASS:
+            self.classes.pop(chat_id, None)
+            self.class_updates[chat_id] = None
+        else:
+            self.classes[chat_id] = class_id
+            self.class_updates[chat_id] = class_id
+        persistence.mark_dirty('chats', self._prepare_write)
+
+    def _prepare_write(self):
+        """Новые чаты и смены класса записываются одной транзакцией"""
+        if not self.pending and not self.class_updates:
+            return None
+        batch, self.pending = self.pending, []
+        classes = [(class_id, chat_id) for chat_id, class_id in self.class_updates.items()]
+        self.class_updates = {}
+
+        def write(conn):
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO chats (chat_id, added_at) VALUES (?, ?)", batch)
+                conn.executemany("UPDATE chats SET class_id = ? WHERE chat_id = ?", classes)
+        return write
+
+    def __len__(self):
+        return len(self.chat_ids)
+
+    def iter_chat_ids(self, batch_size: int = 500, shard: int = 0, shards: int = 1):
+        """Потоковый обход чатов порциями, без копирования всего множества.
+        При shards > 1 возвращаются только чаты с chat_id % shards == shard.
+        Новые чаты видны здесь после persistence.flush()."""
+        last_id = -2 ** 63
+        while True:
+            rows = self.conn.execute(
+                "SELECT chat_id FROM chats WHERE chat_id > ? AND ((chat_id % ?) + ?) % ? = ? "
+                "ORDER BY chat_id LIMIT ?",
+                (last_id, shards, shards, shards, shard, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            for (chat_id,) in rows:
+                yield chat_id
+            last_id = rows[-1][0]
+
+database = connect_database(DATABASE_FILE)
+persistence = PersistenceWorker(DATABASE_FILE, PERSIST_DELAY)
+chat_registry = ChatRegistry(database)
 
 def add_chat(chat_id: int):
     """Добавление нового чата в список"""
-    global CHATS_SET
-    CHATS_SET.add(chat_id)
-    save_chats(CHATS_SET)
-    logger.info(f"Добавлен чат {chat_id}. Текущие чаты: {CHATS_SET}")
-
-def load_answers():
-    """Загрузка ответов из файла"""
-    global answers_dict
-    try:
-        if os.path.exists(ANSWERS_FILE):
-            with open(ANSWERS_FILE, 'r', encoding='utf-8') as f:
-                answers_dict = json.load(f)
-            logger.info(f"✅ Ответы успешно загружены: {answers_dict}")
+    chat_registry.add(chat_id)
+
+class TokenBucket:
+    """Лимит скорости: общий для рассылок или на одного пользователя для команд"""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = None
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.updated = self.paused_until
+        self.tokens = 0
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        """Неблокирующий вариант acquire: False, если токена сейчас нет"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_full(self, now: float) -> bool:
+        return now >= self.paused_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class CommandThrottle:
+    """Фильтр перед обработчиками (группа -1): лимит команд на пользователя и схлопывание
+    одинаковых команд только для чтения в групповом чате в один ответ на первую из них"""
+    def __init__(self, rate: float, burst: int, window: float):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.recent: Dict[tuple, float] = {}
+        self.swept = time.monotonic()
+
+    @staticmethod
+    def parse_command(text: Optional[str]) -> Optional[tuple]:
+        """('week', 'аргументы') из '/week@bot аргументы' или None, если это не команда"""
+        if not text or not text.startswith('/'):
+            return None
+        command, *args = text.split()
+        return command[1:].split('@')[0].lower(), normalize_subject(' '.join(args))
+
+    def _sweep(self, now: float):
+        """Забываются истекшие окна и полные корзины: новая корзина ничем не отличается от полной"""
+        if now - self.swept < self.window:
+            return
+        self.swept = now
+        self.recent = {key: seen_at for key, seen_at in self.recent.items() if now - seen_at < self.window}
+        self.buckets = {user_id: bucket for user_id, bucket in self.buckets.items() if not bucket.is_full(now)}
+
+    def check(self, user_id: int, chat_id: int, group: bool, command: tuple) -> Optional[str]:
+        """Причина отбросить команду или None, если ее нужно обработать"""
+        now = time.monotonic()
+        self._sweep(now)
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst)
+        if not bucket.try_acquire():
+            return 'rate'
+        if group and command[0] in READ_ONLY_COMMANDS:
+            key = (chat_id, *command)
+            seen_at = self.recent.get(key)
+            if seen_at is not None and now - seen_at < self.window:
+                return 'duplicate'
+            self.recent[key] = now
+        return None
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        message, user = update.effective_message, update.effective_user
+        if message is None or user is None or user.id in ADMIN_IDS:
+            return
+        command = self.parse_command(message.text)
+        if command is None:
+            return
+        chat = update.effective_chat
+        reason = self.check(user.id, chat.id, chat.type != 'private', command)
+        if reason is not None:
+            metrics.inc('commands_throttled_total', reason=reason)
+            logger.debug("Команда /%s от %s в чате %s отброшена: %s", command[0], user.id, chat.id, reason)
+            raise ApplicationHandlerStop
+
+command_throttle = CommandThrottle(THROTTLE_USER_RATE, THROTTLE_USER_BURST, COALESCE_WINDOW)
+
+class BroadcastReport:
+    """Итоги одной рассылки"""
+    def __init__(self, name: str):
+        self.name = name
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def finish(self):
+        self.duration = time.monotonic() - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.duration if self.duration > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Рассылка '{self.name}': отправлено {self.sent}, ошибок {self.failed}, "
+            f"повторов {self.retries}, {self.duration:.2f} с ({self.throughput:.1f} сообщ./с)"
+        )
+
+    def __str__(self):
+        return self.summary()
+
+def record_broadcast(report: BroadcastReport):
+    kind = re.split(r'[\s#:]', report.name)[0]
+    metrics.observe('broadcast_seconds', report.duration, kind=kind)
+    metrics.inc('broadcast_messages_total', report.sent, kind=kind, result='sent')
+    metrics.inc('broadcast_messages_total', report.failed, kind=kind, result='failed')
+    metrics.set('broadcast_last_throughput', report.throughput, kind=kind)
+    logger.info("%s", report)
+
+class Broadcaster:
+    """Параллельная рассылка с глобальным и поканальным лимитами"""
+    def __init__(self, rate: float, concurrency: int, chat_interval: float):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.chat_next_slot = {}
+        self.last_report = None
+
+    async def _wait_chat_slot(self, chat_id: int):
+        now = time.monotonic()
+        slot = max(now, self.chat_next_slot.get(chat_id, 0.0))
+        self.chat_next_slot[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _deliver(self, chat_id: int, send, report: BroadcastReport, on_failed=None):
+        error = None
+        for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+            if attempt > 1:
+                report.retries += 1
+            await self._wait_chat_slot(chat_id)
+            await self.bucket.acquire()
+            try:
+                await send(chat_id)
+                report.sent += 1
+                return
+            except RetryAfter as e:
+                error = e
+                logger.warning("Flood control: пауза рассылки на %s с", e.retry_after)
+                self.bucket.pause(e.retry_after)
+            except BadRequest as e:
+                error = e
+                break
+            except (TimedOut, NetworkError) as e:
+                error = e
+                await asyncio.sleep(0.5 * 2 ** attempt)
+            except Exception as e:
+                error = e
+                break
+        report.failed += 1
+        logger.error("Ошибка при отправке в чат %s (%s): %s", chat_id, report.name, error)
+        if on_failed is not None:
+            on_failed(chat_id, error)
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        self.chat_next_slot = {
+            chat_id: slot for chat_id, slot in self.chat_next_slot.items() if slot > now
+        }
+
+    async def broadcast(self, name: str, chat_ids, send, on_failed=None) -> BroadcastReport:
+        """Отправка send(chat_id) во все чаты из chat_ids; on_failed(chat_id, error) - после всех попыток"""
+        report = BroadcastReport(name)
+        chats = iter(chat_ids)
+
+        async def worker():
+            for chat_id in chats:
+                await self._deliver(chat_id, send, report, on_failed)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        report.finish()
+        self._forget_idle_chats()
+        self.last_report = report
+        record_broadcast(report)
+        return report
+
+broadcaster = Broadcaster(BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_CHAT_INTERVAL)
+
+def broadcast_shard(name: str, shard: int, shards: int, method: str, kwargs: dict,
+                    outbox_key: Optional[tuple] = None) -> dict:
+    """Рассылка доли чатов (chat_id % shards == shard) в отдельном процессе.
+    С outbox_key = (slot, date) обходятся только неотправленные строки журнала, и журнал пишется здесь же."""
+    concurrency = max(1, BROADCAST_CONCURRENCY // shards)
+
+    async def run():
+        request = HTTPXRequest(connection_pool_size=concurrency)
+        bot = Bot(TELEGRAM_BOT_TOKEN, request=request)
+        shard_broadcaster = Broadcaster(BROADCAST_RATE / shards, concurrency, BROADCAST_CHAT_INTERVAL)
+        conn = connect_database(DATABASE_FILE)
+        shard_outbox = Outbox(conn, write_behind=False) if outbox_key else None
+        if shard_outbox:
+            chat_ids = shard_outbox.iter_due(*outbox_key, time.time(), shard=shard, shards=shards)
+            on_failed = lambda chat_id, error: shard_outbox.mark_failed(chat_id, *outbox_key, error)
         else:
-            logger.info("Файл с ответами не найден, создаем новый")
-            answers_dict = {}
-    except Exception as e:
-        logger.error(f"❌ Ошибка при загрузке ответов: {e}")
+            chat_ids = ChatRegistry(conn).iter_chat_ids(shard=shard, shards=shards)
+            on_failed = None
+
+        async def send(chat_id):
+            await getattr(bot, method)(chat_id=chat_id, **kwargs)
+            if shard_outbox:
+                shard_outbox.mark_sent(chat_id, *outbox_key)
+
+        try:
+            report = await shard_broadcaster.broadcast(f"{name}#{shard}", chat_ids, send, on_failed)
+        finally:
+            # bot.initialize() (лишний getMe) не вызывался, а без него bot.shutdown() пул соединений не закрывает
+            await request.shutdown()
+            if shard_outbox:
+                shard_outbox.write_now()
+            conn.close()
+        return {'sent': report.sent, 'failed': report.failed, 'retries': report.retries}
+
+    return asyncio.run(run())
+
+class ShardedBroadcaster:
+    """Рассылка, разделенная по chat_id между несколькими процессами"""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool = None
+
+    async def broadcast(self, name: str, method: str, kwargs: dict, outbox_key: Optional[tuple] = None) -> BroadcastReport:
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        await persistence.flush()
+        report = BroadcastReport(name)
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.pool, broadcast_shard, name, shard, self.workers, method, kwargs, outbox_key)
+            for shard in range(self.workers)
+        ))
+        for result in results:
+            report.sent += result['sent']
+            report.failed += result['failed']
+            report.retries += result['retries']
+        report.finish()
+        broadcaster.last_report = report
+        record_broadcast(report)
+        return report
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+sharded_broadcaster = ShardedBroadcaster(BROADCAST_WORKERS)
+
+async def broadcast_message(bot, name: str, method: str, **kwargs) -> BroadcastReport:
+    """Рассылка одного сообщения во все чаты: в этом процессе или по шардам"""
+    await persistence.flush()
+    if BROADCAST_WORKERS > 1:
+        return await sharded_broadcaster.broadcast(name, method, kwargs)
 
-def save_answers():
-    """Сохранение ответов в файл"""
+    async def send(chat_id):
+        await getattr(bot, method)(chat_id=chat_id, **kwargs)
+
+    return await broadcaster.broadcast(name, chat_registry.iter_chat_ids(), send)
+
+background_broadcasts = set()
+
+async def _run_background_broadcast(bot, name: str, method: str, kwargs: dict):
     try:
-        logger.info(f"Попытка сохранения ответов: {answers_dict}")
-        with open(ANSWERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(answers_dict, f, ensure_ascii=False, indent=2)
-        logger.info("✅ Ответы успешно сохранены")
+        await broadcast_message(bot, name, method, **kwargs)
     except Exception as e:
-        logger.error(f"❌ Ошибка при сохранении ответов: {e}")
+        logger.error("❌ Ошибка фоновой рассылки %s: %s", name, e)
+
+def broadcast_in_background(bot, name: str, method: str, **kwargs) -> asyncio.Future:
+    """Рассылка без ожидания: обработчик отвечает сразу, а следующие обновления
+    того же пользователя не стоят в очереди до конца рассылки"""
+    task = asyncio.ensure_future(_run_background_broadcast(bot, name, method, kwargs))
+    background_broadcasts.add(task)
+    task.add_done_callback(background_broadcasts.discard)
+    return task
+
+class Outbox:
+    """Журнал запланированных рассылок: строка на каждую тройку (chat_id, slot, date).
+    Доставленные строки отмечаются по ходу рассылки, поэтому после перезапуска она продолжается с места остановки."""
+    def __init__(self, conn: sqlite3.Connection, write_behind: bool = True):
+        self.conn = conn
+        self.write_behind = write_behind
+        self.updates = []
+        self.active = set()
+        self.last_write = time.monotonic()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox_messages ("
+                "slot TEXT NOT NULL, date TEXT NOT NULL, text TEXT NOT NULL, image_path TEXT, "
+                "expires_at REAL NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (slot, date))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "chat_id INTEGER NOT NULL, slot TEXT NOT NULL, date TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt REAL NOT NULL DEFAULT 0, sent_at REAL, error TEXT, "
+                "PRIMARY KEY (slot, date, chat_id))"
+            )
+
+    @staticmethod
+    def _enqueue(conn: sqlite3.Connection, slot: str, date: str, text: str, image_path: Optional[str],
+                 expires_at: float, class_id: str, other_classes: List[str]):
+        """Текст рассылки фиксируется при первой постановке; строки добавляются для всех чатов класса.
+        В класс по умолчанию попадают чаты без класса и чаты, чей класс больше не существует."""
+        if class_id == DEFAULT_CLASS:
+            placeholders = ', '.join('?' * len(other_classes))
+            condition, params = f"class_id IS NULL OR class_id NOT IN ({placeholders})", other_classes
+        else:
+            condition, params = "class_id = ?", [class_id]
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO outbox_messages (slot, date, text, image_path, expires_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (slot, date, text, image_path, expires_at, time.time())
+            )
+            conn.execute(
+                f"INSERT OR IGNORE INTO outbox (chat_id, slot, date) SELECT chat_id, ?, ? FROM chats WHERE {condition}",
+                [slot, date, *params]
+            )
+
+    def message(self, slot: str, date: str) -> Optional[tuple]:
+        return self.conn.execute(
+            "SELECT text, image_path, expires_at FROM outbox_messages WHERE slot = ? AND date = ?", (slot, date)
+        ).fetchone()
+
+    def iter_due(self, slot: str, date: str, now: float, batch_size: int = 500, shard: int = 0, shards: int = 1):
+        """Неотправленные чаты, для которых подошло время попытки (порциями, как iter_chat_ids)"""
+        last_id = -2 ** 63
+        while True:
+            rows = self.conn.execute(
+                "SELECT chat_id FROM outbox WHERE slot = ? AND date = ? AND status = 'pending' "
+                "AND next_attempt <= ? AND chat_id > ? AND ((chat_id % ?) + ?) % ? = ? "
+                "ORDER BY chat_id LIMIT ?",
+                (slot, date, now, last_id, shards, shards, shards, shard, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            for (chat_id,) in rows:
+                yield chat_id
+            last_id = rows[-1][0]
+
+    def next_attempt(self, slot: str, date: str) -> Optional[float]:
+        return self.conn.execute(
+            "SELECT MIN(next_attempt) FROM outbox WHERE slot = ? AND date = ? AND status = 'pending'", (slot, date)
+        ).fetchone()[0]
+
+    def unfinished(self, now: float) -> List[tuple]:
+        """Рассылки, прерванные до истечения срока"""
+        return self.conn.execute(
+            "SELECT slot, date FROM outbox_messages m WHERE expires_at > ? AND EXISTS ("
+            "SELECT 1 FROM outbox o WHERE o.slot = m.slot AND o.date = m.date AND o.status = 'pending')",
+            (now,)
+        ).fetchall()
+
+    def mark_sent(self, chat_id: int, slot: str, date: str):
+        self._record('sent', chat_id, slot, date, None)
+
+    def mark_failed(self, chat_id: int, slot: str, date: str, error):
+        self._record('failed', chat_id, slot, date, str(error))
+
+    def _record(self, *update):
+        self.updates.append((*update, time.time()))
+        if self.write_behind:
+            persistence.mark_dirty('outbox', self._prepare_write)
+        elif time.monotonic() - self.last_write >= PERSIST_DELAY:
+            self.write_now()
+
+    def _prepare_write(self):
+        if not self.updates:
+            return None
+        updates, self.updates = self.updates, []
+        sent = [(moment, slot, date, chat_id) for status, chat_id, slot, date, _, moment in updates if status == 'sent']
+        failed = [
+            (error, moment, OUTBOX_RETRY_DELAY, OUTBOX_MAX_ATTEMPTS, slot, date, chat_id)
+            for status, chat_id, slot, date, error, moment in updates if status == 'failed'
+        ]
+
+        def write(conn):
+            with conn:
+                conn.executemany(
+                    "UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1 "
+                    "WHERE slot = ? AND date = ? AND chat_id = ?",
+                    sent
+                )
+                conn.executemany(
+                    "UPDATE outbox SET attempts = attempts + 1, error = ?, next_attempt = ? + ? * (1 << attempts), "
+                    "status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                    "WHERE slot = ? AND date = ? AND chat_id = ?",
+                    failed
+                )
+        return write
+
+    def write_now(self):
+        """Запись журнала через собственное соединение (в процессах-шардах)"""
+        write = self._prepare_write()
+        if write is not None:
+            write(self.conn)
+        self.last_write = time.monotonic()
+
+    @staticmethod
+    def _expire(conn: sqlite3.Connection, slot: str, date: str):
+        with conn:
+            conn.execute(
+                "UPDATE outbox SET status = 'expired' WHERE slot = ? AND date = ? AND status = 'pending'", (slot, date)
+            )
+
+    @staticmethod
+    def prune(conn: sqlite3.Connection):
+        """Удаление журнала старше OUTBOX_KEEP_DAYS дней"""
+        before = (moscow_now() - timedelta(days=OUTBOX_KEEP_DAYS)).date().isoformat()
+        with conn:
+            conn.execute("DELETE FROM outbox WHERE date < ?", (before,))
+            conn.execute("DELETE FROM outbox_messages WHERE date < ?", (before,))
+
+    async def enqueue(self, slot: str, date: str, text: str, expires_at: float, image_path: str = None,
+                      class_id: str = DEFAULT_CLASS):
+        """Постановка рассылки в журнал для всех чатов класса, которые ее еще не получили"""
+        other_classes = [other for other in schedules.classes if other != DEFAULT_CLASS]
+        await persistence.flush()
+        await persistence.call(
+            lambda conn: self._enqueue(conn, slot, date, text, image_path, expires_at, class_id, other_classes)
+        )
+
+    async def drain(self, bot, slot: str, date: str):
+        """Доставка по журналу с повторами, пока есть неотправленные строки и не истек срок"""
+        message = self.message(slot, date)
+        if message is None or (slot, date) in self.active:
+            return
+        text, image_path, expires_at = message
+        name = f"{slot} {date}"
+        self.active.add((slot, date))
+        try:
+            while time.time() < expires_at:
+                await self._deliver_due(bot, name, slot, date, text, image_path)
+                await persistence.flush()
+                retry_at = self.next_attempt(slot, date)
+                if retry_at is None:
+                    return
+                await asyncio.sleep(max(0.0, min(retry_at, expires_at) - time.time()))
+            await persistence.call(lambda conn: self._expire(conn, slot, date))
+            logger.warning("Рассылка %s не завершена до истечения срока", name)
+        finally:
+            self.active.discard((slot, date))
+
+    async def _upload_image(self, bot, name: str, slot: str, date: str, text: str, image_path: str) -> Optional[str]:
+        """file_id изображения; при первой отправке файл загружается в один из чатов рассылки"""
+        if not os.path.exists(image_path):
+            return None
+        if image_file_ids.get(image_path) is None:
+            first_chat = next(self.iter_due(slot, date, time.time()), None)
+            if first_chat is None:
+                return None
+
+            async def upload(chat_id):
+                await send_image(bot, chat_id, image_path, text)
+                self.mark_sent(chat_id, slot, date)
+
+            await broadcaster.broadcast(
+                f"{name}:upload", [first_chat], upload,
+                lambda chat_id, error: self.mark_failed(chat_id, slot, date, error)
+            )
+            await persistence.flush()
+        return image_file_ids.get(image_path)
+
+    async def _deliver_due(self, bot, name: str, slot: str, date: str, text: str, image_path: Optional[str]):
+        method, kwargs = 'send_message', {'text': text}
+        if image_path:
+            file_id = await self._upload_image(bot, name, slot, date, text, image_path)
+            if file_id:
+                method, kwargs = 'send_photo', {'photo': file_id, 'caption': text}
+
+        if BROADCAST_WORKERS > 1:
+            await sharded_broadcaster.broadcast(name, method, kwargs, outbox_key=(slot, date))
+            return
+
+        async def send(chat_id):
+            await getattr(bot, method)(chat_id=chat_id, **kwargs)
+            self.mark_sent(chat_id, slot, date)
+
+        await broadcaster.broadcast(
+            name, self.iter_due(slot, date, time.time()), send,
+            lambda chat_id, error: self.mark_failed(chat_id, slot, date, error)
+        )
+
+outbox = Outbox(database)
+
+class AnswersStore:
+    """Ответы по предметам в SQLite: чтение из памяти, каждый предмет пишется отдельной транзакцией"""
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.subject_names = {}
+        self.loaded: Dict[str, List[Dict[str, str]]] = {}
+        self.legacy = None
+        self._index = None
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer_subjects ("
+                "subject TEXT PRIMARY KEY, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "subject TEXT NOT NULL, position INTEGER NOT NULL, type TEXT NOT NULL, content TEXT NOT NULL, "
+                "PRIMARY KEY (subject, position))"
+            )
+
+    def load(self):
+        """Загрузка списка предметов; сами ответы читаются при первом запросе.
+        Только читает: старый файл переносится в базу вызовом import_legacy() из цикла событий."""
+        try:
+            rows = self.conn.execute("SELECT subject FROM answer_subjects ORDER BY created_at").fetchall()
+            self.subject_names = {subject: None for (subject,) in rows}
+            self._index = None
+            if not self.subject_names and os.path.exists(LEGACY_ANSWERS_FILE):
+                with open(LEGACY_ANSWERS_FILE, 'r', encoding='utf-8') as f:
+                    self.legacy = json.load(f)
+            logger.info("✅ Загружено предметов с ответами: %d", len(self.subject_names))
+        except Exception as e:
+            logger.error("❌ Ошибка при загрузке ответов: %s", e)
+
+    def import_legacy(self):
+        """Однократный перенос ответов из старого файла, прочитанного в load()"""
+        legacy, self.legacy = self.legacy, None
+        if not legacy:
+            return
+        for subject, answers in legacy.items():
+            self.put(subject, answers)
+        logger.info("Перенесено предметов из %s: %d", LEGACY_ANSWERS_FILE, len(legacy))
+
+    def subjects(self) -> List[str]:
+        return list(self.subject_names)
+
+    @property
+    def index(self) -> SubjectIndex:
+        if self._index is None:
+            self._index = SubjectIndex(self.subject_names)
+        return self._index
+
+    def resolve(self, query: str) -> Optional[str]:
+        """Название предмета по запросу пользователя (с учетом опечаток и регистра)"""
+        if query in self.subject_names:
+            return query
+        return self.index.resolve(query)
+
+    def __contains__(self, subject: str) -> bool:
+        return subject in self.subject_names
+
+    def __len__(self):
+        return len(self.subject_names)
+
+    def get(self, subject: str) -> Optional[List[Dict[str, str]]]:
+        if subject not in self.subject_names:
+            return None
+        if subject not in self.loaded:
+            rows = self.conn.execute(
+                "SELECT type, content FROM answers WHERE subject = ? ORDER BY position", (subject,)
+            ).fetchall()
+            self.loaded[subject] = [{"type": kind, "content": content} for kind, content in rows]
+        return self.loaded[subject]
+
+    def put(self, subject: str, answers: List[Dict[str, str]]):
+        """Замена ответов одного предмета; на диск она попадает в фоне одной транзакцией"""
+        if subject not in self.subject_names:
+            self.subject_names[subject] = None
+            self._index = None
+        self.loaded[subject] = list(answers)
+        persistence.mark_dirty(f"answers:{subject}", lambda: self._prepare_write(subject))
+        logger.info("✅ Сохранены ответы для предмета %s: %d шт.", subject, len(answers))
+
+    def delete(self, subject: str):
+        self.subject_names.pop(subject, None)
+        self.loaded.pop(subject, None)
+        self._index = None
+        persistence.mark_dirty(f"answers:{subject}", lambda: self._prepare_write(subject))
+
+    def _prepare_write(self, subject: str):
+        """Снимок текущего состояния предмета: замена ответов или удаление"""
+        if subject not in self.subject_names:
+            def write(conn):
+                with conn:
+                    conn.execute("DELETE FROM answers WHERE subject = ?", (subject,))
+                    conn.execute("DELETE FROM answer_subjects WHERE subject = ?", (subject,))
+            return write
+
+        now = time.time()
+        rows = [
+            (subject, position, answer["type"], answer["content"])
+            for position, answer in enumerate(self.loaded[subject])
+        ]
+
+        def write(conn):
+            with conn:
+                conn.execute("DELETE FROM answers WHERE subject = ?", (subject,))
+                conn.executemany("INSERT INTO answers (subject, position, type, content) VALUES (?, ?, ?, ?)", rows)
+                conn.execute(
+                    "INSERT INTO answer_subjects (subject, created_at, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(subject) DO UPDATE SET updated_at = excluded.updated_at",
+                    (subject, now, now)
+                )
+        return write
+
+    @staticmethod
+    def compact(conn: sqlite3.Connection):
+        """Периодическое сжатие: перенос WAL в основной файл и обновление статистики"""
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("PRAGMA optimize")
+            logger.info("База данных сжата")
+        except Exception as e:
+            logger.error("❌ Ошибка при сжатии базы данных: %s", e)
+
+answers_store = AnswersStore(database)
+
+class UploadSessions:
+    """Сессии загрузки ответов администраторами: в памяти только предмет, счетчик и время
+    последнего сообщения, сами ответы сразу пишутся в таблицу upload_items и переживают перезапуск.
+    Сессия без сообщений дольше ttl секунд удаляется, ответов в ней не больше max_items."""
+    def __init__(self, conn: sqlite3.Connection, ttl: float, max_items: int):
+        self.conn = conn
+        self.ttl = ttl
+        self.max_items = max_items
+        self.sessions: Dict[int, list] = {}
+        self.pending = []
+        self.changes = {}
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_sessions ("
+                "user_id INTEGER PRIMARY KEY, subject TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_items ("
+                "user_id INTEGER NOT NULL, position INTEGER NOT NULL, type TEXT NOT NULL, content TEXT NOT NULL, "
+                "PRIMARY KEY (user_id, position))"
+            )
+
+    def load(self):
+        """Восстановление незавершенных сессий после перезапуска (без самих ответов)"""
+        try:
+            rows = self.conn.execute(
+                "SELECT s.user_id, s.subject, s.updated_at, COALESCE(MAX(i.position) + 1, 0) "
+                "FROM upload_sessions s LEFT JOIN upload_items i ON i.user_id = s.user_id GROUP BY s.user_id"
+            ).fetchall()
+            self.sessions = {user_id: [subject, count, updated_at] for user_id, subject, updated_at, count in rows}
+            if self.sessions:
+                logger.info("Восстановлено сессий загрузки ответов: %d", len(self.sessions))
+        except Exception as e:
+            logger.error("❌ Ошибка при загрузке сессий загрузки ответов: %s", e)
+
+    def get(self, user_id: int) -> Optional[list]:
+        """[предмет, число ответов, время последнего сообщения] или None, если сессии нет или она истекла"""
+        session = self.sessions.get(user_id)
+        if session is not None and time.time() - session[2] > self.ttl:
+            self.drop(user_id)
+            return None
+        return session
+
+    def start(self, user_id: int, subject: str):
+        """Новая сессия; незавершенная сессия того же пользователя отбрасывается"""
+        now = time.time()
+        self.pending = [item for item in self.pending if item[0] != user_id]
+        self.sessions[user_id] = [subject, 0, now]
+        self.changes[user_id] = (subject, now, True)
+        persistence.mark_dirty('uploads', self._prepare_write)
+
+    def append(self, user_id: int, kind: str, content: str) -> Optional[int]:
+        """Добавление ответа; возвращает число ответов в сессии или None, если лимит исчерпан"""
+        session = self.sessions[user_id]
+        subject, count, _ = session
+        if count >= self.max_items:
+            return None
+        now = time.time()
+        self.pending.append((user_id, count, kind, content))
+        session[1], session[2] = count + 1, now
+        started = self.changes.get(user_id)
+        self.changes[user_id] = (subject, now, started is not None and started[2])
+        persistence.mark_dirty('uploads', self._prepare_write)
+        return count + 1
+
+    async def finish(self, user_id: int) -> List[Dict[str, str]]:
+        """Ответы сессии из базы; сама сессия удаляется"""
+        await persistence.flush()
+        rows = await persistence.call(lambda conn: conn.execute(
+            "SELECT type, content FROM upload_items WHERE user_id = ? ORDER BY position", (user_id,)
+        ).fetchall())
+        self.drop(user_id)
+        return [{"type": kind, "content": content} for kind, content in rows]
+
+    def drop(self, user_id: int):
+        if self.sessions.pop(user_id, None) is None:
+            return
+        self.pending = [item for item in self.pending if item[0] != user_id]
+        self.changes[user_id] = None
+        persistence.mark_dirty('uploads', self._prepare_write)
+
+    def expire(self) -> int:
+        """Удаление сессий, в которые давно ничего не присылали"""
+        deadline = time.time() - self.ttl
+        expired = [user_id for user_id, (_, _, updated_at) in self.sessions.items() if updated_at < deadline]
+        for user_id in expired:
+            logger.info("Сессия загрузки ответов пользователя %s истекла", user_id)
+            self.drop(user_id)
+        return len(expired)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _prepare_write(self):
+        """Начатые, удаленные и обновленные сессии и новые ответы пишутся одной транзакцией"""
+        if not self.pending and not self.changes:
+            return None
+        items, self.pending = self.pending, []
+        changes, self.changes = self.changes, {}
+        cleared = [(user_id,) for user_id, change in changes.items() if change is None or change[2]]
+        sessions = [(user_id, change[0], change[1]) for user_id, change in changes.items() if change is not None]
+
+        def write(conn):
+            with conn:
+                conn.executemany("DELETE FROM upload_items WHERE user_id = ?", cleared)
+                conn.executemany("DELETE FROM upload_sessions WHERE user_id = ?", cleared)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO upload_sessions (user_id, subject, updated_at) VALUES (?, ?, ?)", sessions
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO upload_items (user_id, position, type, content) VALUES (?, ?, ?, ?)", items
+                )
+        return write
+
+upload_sessions = UploadSessions(database, UPLOAD_SESSION_TTL, UPLOAD_MAX_ITEMS)
+
+async def expire_upload_sessions() -> None:
+    """Задача планировщика: сессии и их запись меняются только в цикле событий"""
+    upload_sessions.expire()
 
 async def add_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Добавление ответов для предмета"""
     user_id = update.effective_user.id
-    logger.info(f"Команда add_answer получена. ID пользователя: {user_id}")
+    logger.info("Команда add_answer получена. ID пользователя: %s", user_id)
     
     if user_id not in ADMIN_IDS:
-        logger.warning(f"Отказано в доступе пользователю {user_id}")
+        logger.warning("Отказано в доступе пользователю %s", user_id)
         await update.message.reply_text("⛔️ Эта команда доступна только администратору")
         return
     
@@ -193,23 +1743,19 @@ async def add_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             return
         
         subject = ' '.join(args)
-        logger.info(f"Начало добавления ответов для предмета: {subject}")
+        logger.info("Начало добавления ответов для предмета: %s", subject)
         
-        global adding_answers_states
-        adding_answers_states[user_id] = {
-            'subject': subject,
-            'answers': []
-        }
-        logger.info(f"Состояние добавления ответов установлено для пользователя {user_id}: {adding_answers_states[user_id]}")
+        upload_sessions.start(user_id, subject)
+        logger.debug("Сессия загрузки ответов начата для пользователя %s: %s", user_id, subject)
         
         await update.message.reply_text(
             f"📝 Отправьте ответы для предмета '{subject}'\n"
-            "Можно отправлять текст и фотографии.\n"
+            f"Можно отправлять текст и фотографии (не больше {upload_sessions.max_items}).\n"
             "Для завершения отправьте /done"
         )
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при добавлении ответов: {e}")
+        logger.error("❌ Ошибка при добавлении ответов: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при добавлении ответов")
 
 async def handle_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -217,48 +1763,31 @@ async def handle_done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     add_chat(chat_id)  
-    logger.info(f"Получена команда /done от пользователя {user_id}")
-    
-    global adding_answers_states
-    logger.info(f"Текущие состояния при получении /done: {adding_answers_states}")
+    logger.info("Получена команда /done от пользователя %s", user_id)
     
-    if user_id not in adding_answers_states:
+    session = upload_sessions.get(user_id)
+    if session is None:
         await update.message.reply_text("❌ Вы не находитесь в режиме добавления ответов")
         return
     
     try:
-        state = adding_answers_states[user_id]
-        subject = state['subject']
-        answers = state['answers']
+        subject = session[0]
+        answers = await upload_sessions.finish(user_id)
         
         if not answers:
             await update.message.reply_text("❌ Нет добавленных ответов")
-            del adding_answers_states[user_id]
             return
         
-        
-        global answers_dict
-        answers_dict[subject] = answers
-        logger.info(f"Сохранение ответов для предмета {subject}: {answers}")
-        save_answers()
-        
+        answers_store.put(subject, answers)
+        logger.info("Завершено добавление ответов для предмета %s", subject)
+        await update.message.reply_text("✅ Ответы успешно сохранены")
         
         notification = f"📚 Администратор добавил ответы для предмета: {subject}"
-        logger.info(f"Отправка уведомлений в чаты: {CHATS_SET}")
-        for chat_id in CHATS_SET:
-            try:
-                await context.bot.send_message(chat_id=chat_id, text=notification)
-                logger.info(f"Уведомление отправлено в чат {chat_id}")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
-        
-        
-        del adding_answers_states[user_id]
-        logger.info(f"Завершено добавление ответов для предмета {subject}")
-        await update.message.reply_text("✅ Ответы успешно сохранены")
+        logger.info("Отправка уведомлений в чаты: %d", len(chat_registry))
+        broadcast_in_background(context.bot, "answers_added", "send_message", text=notification)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при завершении добавления ответов: {e}")
+        logger.error("❌ Ошибка при завершении добавления ответов: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при сохранении ответов")
 
 async def handle_answer_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -270,86 +1799,137 @@ async def handle_answer_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     if update.message.text and update.message.text.startswith('/'):
         return
     
-    logger.info(f"Получено сообщение от пользователя {user_id}. Текст: {update.message.text if update.message.text else 'фото'}")
-    logger.info(f"Текущие состояния добавления ответов: {adding_answers_states}")
-    
+    logger.debug("Получено сообщение от пользователя %s. Текст: %s", user_id, update.message.text if update.message.text else 'фото')
    
     if user_id not in ADMIN_IDS:
-        logger.info(f"Сообщение проигнорировано - пользователь не администратор")
+        logger.debug("Сообщение проигнорировано - пользователь не администратор")
         return
     
-    
-    if user_id not in adding_answers_states:
-        logger.info(f"Сообщение проигнорировано - пользователь не в режиме добавления ответов")
+    await store_loader.wait('uploads')
+    session = upload_sessions.get(user_id)
+    if session is None:
+        logger.debug("Сообщение проигнорировано - пользователь не в режиме добавления ответов")
         return
     
-    logger.info(f"Обработка сообщения в режиме добавления ответов для предмета: {adding_answers_states[user_id]['subject']}")
+    logger.info("Обработка сообщения в режиме добавления ответов для предмета: %s", session[0])
     
     try:
         
         if update.message.text and not update.message.text.startswith('/'):
-            adding_answers_states[user_id]['answers'].append({"type": "text", "content": update.message.text})
-            logger.info(f"Добавлен текстовый ответ: {update.message.text[:50]}...")
+            kind, content = "text", update.message.text
         elif update.message.photo:
-            photo_id = update.message.photo[-1].file_id
-            adding_answers_states[user_id]['answers'].append({"type": "photo", "content": photo_id})
-            logger.info(f"Добавлено фото с ID: {photo_id}")
+            kind, content = "photo", update.message.photo[-1].file_id
+        else:
+            return
         
-        await update.message.reply_text("✅ Ответ добавлен. Отправьте еще или /done для завершения")
+        count = upload_sessions.append(user_id, kind, content)
+        if count is None:
+            await update.message.reply_text(
+                f"❗️ В одной загрузке не больше {upload_sessions.max_items} ответов. Отправьте /done, чтобы сохранить их"
+            )
+            return
+        if kind == "text":
+            logger.info("Добавлен текстовый ответ: %s...", content[:50])
+        else:
+            logger.info("Добавлено фото с ID: %s", content)
+        await update.message.reply_text(f"✅ Ответ добавлен ({count}). Отправьте еще или /done для завершения")
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при обработке ответа: {e}")
+        logger.error("❌ Ошибка при обработке ответа: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при обработке ответа")
 
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Разбиение текста на части не длиннее limit по границам строк"""
+    chunks, current = [], ""
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+def plan_answer_delivery(answers: List[Dict[str, str]]) -> List[list]:
+    """План отправки: подряд идущие фото собираются в альбомы, тексты упаковываются в сообщения"""
+    plan = []
+    for answer in answers:
+        if answer["type"] == "photo":
+            if plan and plan[-1][0] == "photos" and len(plan[-1][1]) < MEDIA_GROUP_SIZE:
+                plan[-1][1].append(answer["content"])
+            else:
+                plan.append(["photos", [answer["content"]]])
+        elif answer["type"] == "text":
+            for chunk in split_text(answer["content"]):
+                if plan and plan[-1][0] == "text" and len(plan[-1][1]) + 2 + len(chunk) <= MAX_MESSAGE_LENGTH:
+                    plan[-1][1] += f"\n\n{chunk}"
+                else:
+                    plan.append(["text", chunk])
+    return plan
+
+def not_found_message(query: str, suggestions: List[str]) -> str:
+    message = f"❌ Ответы для предмета '{query}' не найдены"
+    if suggestions:
+        message += "\n\n💡 Возможно, вы имели в виду:\n" + "\n".join(f"• {name}" for name in suggestions)
+    return message
+
 async def get_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Получение ответов по предмету"""
     try:
-        logger.info("Запрос на получение ответов")
+        logger.debug("Запрос на получение ответов")
         args = context.args
         if not args:
             await update.message.reply_text("❗️ Укажите предмет после команды, например:\n/get_answer Математика")
             return
         
-        subject = ' '.join(args)
-        logger.info(f"Поиск ответов для предмета: {subject}")
-        
-        
-        logger.info(f"Текущие ответы в базе: {answers_dict}")
+        query = ' '.join(args)
+        logger.info("Поиск ответов для предмета: %s", query)
         
-        if subject not in answers_dict:
-            logger.warning(f"Ответы не найдены для предмета: {subject}")
-            await update.message.reply_text(f"❌ Ответы для предмета '{subject}' не найдены")
+        subject = answers_store.resolve(query)
+        if subject is None:
+            logger.warning("Ответы не найдены для предмета: %s", query)
+            await update.message.reply_text(not_found_message(query, answers_store.index.suggestions(query)))
             return
+        answers = answers_store.get(subject)
         
         await update.message.reply_text(f"📚 Ответы по предмету: {subject}")
         
        
-        for answer in answers_dict[subject]:
-            logger.info(f"Отправка ответа типа: {answer['type']}")
-            if answer["type"] == "text":
-                await update.message.reply_text(answer["content"])
-            elif answer["type"] == "photo":
-                await update.message.reply_photo(answer["content"])
+        for kind, payload in plan_answer_delivery(answers):
+            if kind == "text":
+                await update.message.reply_text(payload)
+            elif len(payload) == 1:
+                await update.message.reply_photo(payload[0])
+            else:
+                await update.message.reply_media_group([InputMediaPhoto(photo_id) for photo_id in payload])
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при получении ответов: {e}")
+        logger.error("❌ Ошибка при получении ответов: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при получении ответов")
 
 async def list_answers(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Список всех доступных предметов с ответами"""
     try:
-        if not answers_dict:
+        if not len(answers_store):
             await update.message.reply_text("📚 Список ответов пуст")
             return
         
         message = "📚 Доступные предметы с ответами:\n\n"
-        for subject in answers_dict.keys():
+        for subject in answers_store.subjects():
             message += f"• {subject}\n"
         
         await update.message.reply_text(message)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при получении списка ответов: {e}")
+        logger.error("❌ Ошибка при получении списка ответов: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при получении списка ответов")
 
 async def del_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -364,53 +1944,520 @@ async def del_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             await update.message.reply_text("❗️ Укажите предмет после команды, например:\n/del_answer Математика")
             return
         
-        subject = ' '.join(args)
+        query = ' '.join(args)
+        subject = query if query in answers_store else answers_store.index.exact.get(normalize_subject(query))
         
-        if subject in answers_dict:
-            del answers_dict[subject]
-            save_answers()
+        if subject is not None:
+            answers_store.delete(subject)
             await update.message.reply_text(f"✅ Ответы для предмета '{subject}' удалены")
             
             notification = f"🗑 Администратор удалил ответы для предмета: {subject}"
-            logger.info(f"Отправка уведомлений в чаты: {CHATS_SET}")
-            for chat_id in CHATS_SET:
-                try:
-                    await context.bot.send_message(chat_id=chat_id, text=notification)
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+            logger.info("Отправка уведомлений в чаты: %d", len(chat_registry))
+            broadcast_in_background(context.bot, "answers_deleted", "send_message", text=notification)
         else:
-            await update.message.reply_text(f"❌ Ответы для предмета '{subject}' не найдены")
+            await update.message.reply_text(not_found_message(query, answers_store.index.suggestions(query)))
+        
+    except Exception as e:
+        logger.error("❌ Ошибка при удалении ответов: %s", e)
+        await update.message.reply_text("❌ Произошла ошибка при удалении ответов")
+
+class WeatherService:
+    """Погода с общим пулом соединений, TTL-кэшем и объединением одновременных запросов"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.cache = {}
+        self.in_flight = {}
+        self.session = None
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        import aiohttp
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=10),
+                connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300)
+            )
+        return self.session
+
+    async def _fetch(self, city: str) -> str:
+        with metrics.timer('weather_fetch_seconds', city=city):
+            return await self._request(city)
+
+    async def _request(self, city: str) -> str:
+        url = f"{WEATHER_API_URL}/{city}/today?unitGroup=metric&include=current&key={WEATHER_API_KEY}&contentType=json"
+        async with self._get_session().get(url) as response:
+            data = await response.json()
+            current = data['currentConditions']
+            return f"{city}: {current['temp']}°C, {current['conditions']}"
+
+    async def get(self, city: str) -> str:
+        cached = self.cache.get(city)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        future = self.in_flight.get(city)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(city))
+            self.in_flight[city] = future
+            future.add_done_callback(lambda f: self._on_fetched(city, f))
+        return await asyncio.shield(future)
+
+    def _on_fetched(self, city: str, future: asyncio.Future):
+        self.in_flight.pop(city, None)
+        if not future.cancelled() and future.exception() is None:
+            self.cache[city] = (time.monotonic() + self.ttl, future.result())
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+weather_service = WeatherService(WEATHER_CACHE_TTL)
+
+async def get_weather(city: str) -> str:
+    """Получение погоды для указанного города"""
+    try:
+        return await weather_service.get(city)
+    except Exception as e:
+        logger.error("Ошибка при получении погоды для %s: %s", city, e)
+        return f"Не удалось получить погоду для {city}"
+
+class HomeworkStore:
+    """Домашние задания по датам и предметам: чтение из памяти, запись в таблицу homework в фоне"""
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.entries: Dict[str, Dict[str, tuple]] = {}
+        self.pending = {}
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS homework ("
+                "date TEXT NOT NULL, subject TEXT NOT NULL, text TEXT NOT NULL, source TEXT NOT NULL, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (date, subject))"
+            )
+
+    def load(self):
+        try:
+            since = (moscow_now() - timedelta(days=HOMEWORK_KEEP_DAYS)).date().isoformat()
+            rows = self.conn.execute(
+                "SELECT date, subject, text, source FROM homework WHERE date >= ?", (since,)
+            ).fetchall()
+            self.entries = {}
+            for date, subject, text, source in rows:
+                self.entries.setdefault(date, {})[subject] = (text, source)
+            logger.info("✅ Загружено домашних заданий: %d", len(rows))
+        except Exception as e:
+            logger.error("❌ Ошибка при загрузке домашних заданий: %s", e)
+
+    def for_date(self, date: str) -> Dict[str, str]:
+        return {subject: text for subject, (text, _) in self.entries.get(date, {}).items()}
+
+    def between(self, date_from: str, date_to: str) -> List[tuple]:
+        """(дата, предмет, задание) за период, по порядку дат"""
+        return [
+            (date, subject, text)
+            for date in sorted(self.entries) if date_from <= date <= date_to
+            for subject, (text, _) in self.entries[date].items()
+        ]
+
+    def find_subject(self, date: str, query: str) -> Optional[str]:
+        normalized = normalize_subject(query)
+        return next((subject for subject in self.entries.get(date, {}) if normalize_subject(subject) == normalized), None)
+
+    def _set(self, date: str, subject: str, text: str, source: str):
+        self.entries.setdefault(date, {})[subject] = (text, source)
+        self.pending[(date, subject)] = (text, source)
+
+    def _remove(self, date: str, subject: str):
+        day = self.entries.get(date, {})
+        day.pop(subject, None)
+        if not day:
+            self.entries.pop(date, None)
+        self.pending[(date, subject)] = None
+
+    def put(self, date: str, subject: str, text: str):
+        self._set(date, subject, text, 'manual')
+        persistence.mark_dirty('homework', self._prepare_write)
+
+    def delete(self, date: str, subject: str) -> bool:
+        if subject not in self.entries.get(date, {}):
+            return False
+        self._remove(date, subject)
+        persistence.mark_dirty('homework', self._prepare_write)
+        return True
+
+    def _prepare_write(self):
+        """Все накопленные изменения заданий пишутся одной транзакцией"""
+        now = time.time()
+        changes, self.pending = self.pending, {}
+        upserts = [(date, subject, value[0], value[1], now) for (date, subject), value in changes.items() if value]
+        deletes = [(date, subject) for (date, subject), value in changes.items() if value is None]
+
+        def write(conn):
+            with conn:
+                conn.executemany("DELETE FROM homework WHERE date = ? AND subject = ?", deletes)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO homework (date, subject, text, source, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    upserts
+                )
+        return write
+
+    @staticmethod
+    def prune(conn: sqlite3.Connection):
+        """Удаление заданий старше HOMEWORK_KEEP_DAYS дней"""
+        before = (moscow_now() - timedelta(days=HOMEWORK_KEEP_DAYS)).date().isoformat()
+        with conn:
+            conn.execute("DELETE FROM homework WHERE date < ?", (before,))
+
+homework_store = HomeworkStore(database)
+
+def parse_homework_date(text: str) -> Optional[str]:
+    """Дата из 'сегодня', 'завтра', '21.10', '21.10.2024' или '2024-10-21'"""
+    today = moscow_now().date()
+    text = text.strip().lower()
+    if text in ('сегодня', 'завтра'):
+        return (today + timedelta(days=text == 'завтра')).isoformat()
+    # К '21.10' год дописывается до разбора, иначе 29.02 проверяется по 1900 году
+    for value, date_format in ((text, '%d.%m.%Y'), (text, '%Y-%m-%d'), (f"{text}.{today.year}", '%d.%m.%Y')):
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def next_lesson_date(class_schedule: ClassSchedule, subject: str) -> tuple:
+    """Ближайший (начиная с завтра) день с уроком по предмету и название предмета из расписания"""
+    normalized = normalize_subject(subject)
+    today = moscow_now().date()
+    for offset in range(1, 8):
+        day = today + timedelta(days=offset)
+        for _, lesson in class_schedule.schedule.get(day.strftime('%A'), []):
+            if normalize_subject(lesson) == normalized:
+                return day.isoformat(), lesson
+    return (today + timedelta(days=1)).isoformat(), subject
+
+def format_homework_date(date: str) -> str:
+    day = datetime.strptime(date, '%Y-%m-%d')
+    return f"{day.strftime('%d.%m')} ({day.strftime('%A')})"
+
+async def homework(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Домашнее задание: на ближайшие дни, на дату или по предмету"""
+    try:
+        today = moscow_now().date()
+        date_from, date_to = today.isoformat(), (today + timedelta(days=HOMEWORK_DAYS_AHEAD)).isoformat()
+        query = ' '.join(context.args)
+        date = parse_homework_date(query) if query else None
+        if date is not None:
+            date_from = date_to = date
+        rows = homework_store.between(date_from, date_to)
+        if query and date is None:
+            normalized = normalize_subject(query)
+            rows = [row for row in rows if normalized in normalize_subject(row[1])]
+        
+        if not rows:
+            await update.message.reply_text("🎉 Домашних заданий не найдено!")
+            return
+        
+        lines, last_date = ["📝 Домашнее задание:"], None
+        for date, subject, text in rows:
+            if date != last_date:
+                lines.append(f"\n📅 {format_homework_date(date)}")
+                last_date = date
+            lines.append(f"📚 {subject}: {text}")
+        for chunk in split_text('\n'.join(lines)):
+            await update.message.reply_text(chunk)
+        
+    except Exception as e:
+        logger.error("❌ Ошибка в команде homework: %s", e)
+        await update.message.reply_text("❌ Произошла ошибка при получении домашнего задания")
+
+async def homework_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Добавление домашнего задания вручную (только для администратора)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Эта команда доступна только администратору")
+        return
+    
+    try:
+        args = list(context.args)
+        date = parse_homework_date(args[0]) if args else None
+        if date is not None:
+            args = args[1:]
+        subject, separator, text = ' '.join(args).partition(':')
+        if not separator or not subject.strip() or not text.strip():
+            await update.message.reply_text(
+                "❗️ Укажите предмет и задание, например:\n"
+                "/homework_add Алгебра: №123, 124\n"
+                "/homework_add 21.10 Алгебра: №123, 124"
+            )
+            return
+        
+        subject = subject.strip()
+        if date is None:
+            date, subject = next_lesson_date(schedules.for_chat(update.effective_chat.id), subject)
+        homework_store.put(date, subject, text.strip())
+        logger.info("Добавлено домашнее задание: %s %s", date, subject)
+        await update.message.reply_text(f"✅ Задание по предмету '{subject}' на {format_homework_date(date)} сохранено")
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при удалении ответов: {e}")
-        await update.message.reply_text("❌ Произошла ошибка при удалении ответов")
+        logger.error("❌ Ошибка при добавлении домашнего задания: %s", e)
+        await update.message.reply_text("❌ Произошла ошибка при добавлении домашнего задания")
 
-async def get_weather(city: str) -> str:
-    """Получение погоды для указанного города"""
+async def homework_del(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Удаление домашнего задания (только для администратора)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Эта команда доступна только администратору")
+        return
+    
     try:
-        url = f"https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/{city}/today?unitGroup=metric&include=current&key={WEATHER_API_KEY}&contentType=json"
+        date = parse_homework_date(context.args[0]) if context.args else None
+        if date is None or len(context.args) < 2:
+            await update.message.reply_text("❗️ Укажите дату и предмет, например:\n/homework_del 21.10 Алгебра")
+            return
+        
+        subject = homework_store.find_subject(date, ' '.join(context.args[1:]))
+        if subject is not None and homework_store.delete(date, subject):
+            await update.message.reply_text(f"✅ Задание по предмету '{subject}' на {format_homework_date(date)} удалено")
+        else:
+            await update.message.reply_text("❌ Такое задание не найдено")
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.json()
-                current = data['currentConditions']
-                return f"{city}: {current['temp']}°C, {current['conditions']}"
     except Exception as e:
-        logger.error(f"Ошибка при получении погоды для {city}: {e}")
-        return f"Не удалось получить погоду для {city}"
+        logger.error("❌ Ошибка при удалении домашнего задания: %s", e)
+        await update.message.reply_text("❌ Произошла ошибка при удалении домашнего задания")
+
+def image_dhash(image: 'Image.Image') -> int:
+    """Перцептивный хэш (dHash) изображения"""
+    from PIL import Image
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+def optimize_image(source: str, target: str, max_side: int, quality: int) -> int:
+    """Уменьшение, пережатие и очистка метаданных одного изображения (выполняется в пуле процессов)"""
+    from PIL import Image, ImageOps
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        image.save(target, 'JPEG', quality=quality, optimize=True, progressive=True)
+        # Уже сжатый JPEG нужного размера пересохраняем с его таблицами квантования;
+        # только без поворота по EXIF: иначе original и image различаются пикселями
+        if (original.format == 'JPEG' and image.size == original.size
+                and original.getexif().get(EXIF_ORIENTATION, 1) == 1
+                and os.path.getsize(target) >= os.path.getsize(source)):
+            original.save(target, 'JPEG', quality='keep', optimize=True, progressive=True)
+        return image_dhash(image)
+
+class ImagePreprocessor:
+    """Подготовка оптимизированных копий изображений в отдельной папке"""
+    def __init__(self, source_dir: Path, output_dir: Path):
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.manifest_file = output_dir / 'manifest.json'
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest: dict):
+        tmp_file = self.manifest_file.with_suffix('.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_file, self.manifest_file)
+
+    def run(self) -> List[str]:
+        """Обрабатывает новые и измененные файлы, возвращает список без дубликатов"""
+        self.output_dir.mkdir(exist_ok=True)
+        manifest = self._load_manifest()
+        sources = {
+            path.name: path for pattern in ('*.jpg', '*.png') for path in self.source_dir.glob(pattern)
+        }
+
+        for name in set(manifest) - set(sources):
+            Path(manifest.pop(name)['output']).unlink(missing_ok=True)
+
+        pending = []
+        for name, path in sources.items():
+            mtime = path.stat().st_mtime_ns
+            # Расширение исходника остается в имени, чтобы x.jpg и x.png не затирали друг друга
+            output = str(self.output_dir / f"{path.name}.jpg")
+            entry = manifest.get(name)
+            if (entry is None or entry['mtime'] != mtime or entry['output'] != output
+                    or not os.path.exists(output)):
+                if entry is not None and entry['output'] != output:
+                    Path(entry['output']).unlink(missing_ok=True)
+                pending.append((name, str(path), output, mtime))
+
+        if pending:
+            # Процесс уже держит потоки журнала и записи: fork их состояние не копирует корректно
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as pool:
+                hashes = pool.map(
+                    optimize_image,
+                    [source for _, source, _, _ in pending],
+                    [output for _, _, output, _ in pending],
+                    [IMAGE_MAX_SIDE] * len(pending),
+                    [IMAGE_QUALITY] * len(pending)
+                )
+                for (name, _, output, mtime), dhash in zip(pending, hashes):
+                    manifest[name] = {'mtime': mtime, 'output': output, 'hash': dhash}
+            self._save_manifest(manifest)
+            logger.info("Оптимизировано изображений: %d", len(pending))
+
+        unique, seen = [], []
+        for name in sorted(manifest, key=lambda n: (len(n), n)):
+            dhash = manifest[name]['hash']
+            if any(bin(dhash ^ other).count('1') <= IMAGE_DUPLICATE_DISTANCE for other in seen):
+                continue
+            seen.append(dhash)
+            unique.append(manifest[name]['output'])
+        return sorted(unique)
+
+class ImageCatalog:
+    """Список изображений в памяти, перечитывается при изменении папки"""
+    def __init__(self, directory: Path, preprocessor: ImagePreprocessor = None):
+        self.directory = directory
+        self.preprocessor = preprocessor
+        self.images = []
+        self.mtime = None
+        self._refresh_lock = None
+
+    def _scan(self) -> List[str]:
+        if self.preprocessor is not None:
+            try:
+                return self.preprocessor.run()
+            except Exception as e:
+                logger.error("Ошибка при оптимизации изображений, используются исходные: %s", e)
+        return sorted(
+            str(path) for pattern in ('*.jpg', '*.png') for path in self.directory.glob(pattern)
+        )
+
+    def refresh(self) -> List[str]:
+        try:
+            mtime = self.directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            self.images, self.mtime = [], None
+            return self.images
+        if mtime != self.mtime:
+            self.images = self._scan()
+            self.mtime = mtime
+            logger.info("Каталог изображений обновлен: %d файлов", len(self.images))
+        return self.images
 
-def get_random_image() -> str:
+    async def refresh_async(self) -> List[str]:
+        """refresh() для цикла событий: обработка измененной папки идет в отдельном потоке"""
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            return await asyncio.get_running_loop().run_in_executor(None, self.refresh)
+
+class FileIdCache:
+    """Telegram file_id уже загруженных изображений (ключ: путь и mtime файла)"""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file_ids = {}
+        self._upload_lock = None
+        self.load()
+
+    @staticmethod
+    def key(path: str) -> str:
+        return f"{path}:{os.stat(path).st_mtime_ns}"
+
+    def load(self):
+        try:
+            if os.path.exists(self.filename):
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    self.file_ids = json.load(f)
+        except Exception as e:
+            logger.error("Ошибка при загрузке file_id изображений: %s", e)
+
+    @staticmethod
+    def is_current(key: str) -> bool:
+        """Ключ еще указывает на существующий файл с тем же mtime"""
+        path, _, mtime = key.rpartition(':')
+        try:
+            return str(os.stat(path).st_mtime_ns) == mtime
+        except OSError:
+            return False
+
+    def _prepare_write(self):
+        """Снимок для записи; ключи удаленных и переоптимизированных изображений отбрасываются"""
+        self.file_ids = {key: file_id for key, file_id in self.file_ids.items() if self.is_current(key)}
+        file_ids = dict(self.file_ids)
+
+        def write(conn):
+            tmp_file = f"{self.filename}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(file_ids, f)
+            os.replace(tmp_file, self.filename)
+        return write
+
+    def get(self, path: str):
+        return self.file_ids.get(self.key(path))
+
+    def set(self, path: str, file_id: str):
+        self.file_ids[self.key(path)] = file_id
+        persistence.mark_dirty('image_file_ids', self._prepare_write)
+
+    @property
+    def upload_lock(self) -> asyncio.Lock:
+        if self._upload_lock is None:
+            self._upload_lock = asyncio.Lock()
+        return self._upload_lock
+
+image_catalog = ImageCatalog(IMAGES_DIR, ImagePreprocessor(IMAGES_DIR, OPTIMIZED_IMAGES_DIR))
+image_file_ids = FileIdCache(IMAGE_FILE_IDS_FILE)
+
+async def get_random_image() -> str:
     """Получение случайного изображения из папки images"""
     try:
-        images_dir = Path('images')
-        images = list(images_dir.glob('*.jpg')) + list(images_dir.glob('*.png'))
+        images = await image_catalog.refresh_async()
         if images:
-            return str(random.choice(images))
+            return random.choice(images)
         return None
     except Exception as e:
-        logger.error(f"Ошибка при получении изображения: {e}")
+        logger.error("Ошибка при получении изображения: %s", e)
         return None
 
+async def send_image(bot, chat_id: int, image_path: str, caption: str) -> None:
+    """Отправка изображения: файл загружается один раз, дальше используется file_id"""
+    file_id = image_file_ids.get(image_path)
+    if file_id is None:
+        async with image_file_ids.upload_lock:
+            file_id = image_file_ids.get(image_path)
+            if file_id is None:
+                with open(image_path, 'rb') as photo:
+                    sent = await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+                image_file_ids.set(image_path, sent.photo[-1].file_id)
+                return
+    await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+
+async def build_morning_message(class_schedule: ClassSchedule = None) -> str:
+    """Формирование текста утреннего сообщения"""
+    class_schedule = class_schedule or schedules.get()
+    moscow_weather, podolsk_weather = await asyncio.gather(*(get_weather(city) for city in WEATHER_CITIES))
+    today = moscow_now()
+    weekday = today.strftime('%A')
+    body = class_schedule.render_cache.get_daily(
+        'morning', today.date(), lambda: render_morning_body(class_schedule, weekday)
+    )
+    
+    return (
+        f"🌅 Доброе утро! Пусть этот день будет замечательным! ✨\n\n"
+        f"🌤 Погода сегодня:\n🏙 {moscow_weather}\n🌆 {podolsk_weather}\n\n"
+        f"{body}"
+    )
+
+async def deliver_morning_message(bot, chat_id: int, message: str, image_path: str = None) -> None:
+    """Отправка готового утреннего сообщения в чат (ошибки пробрасываются)"""
+    if image_path:
+        await send_image(bot, chat_id, image_path, message)
+    else:
+        await bot.send_message(
+            chat_id=chat_id,
+            text=message
+        )
+
 async def send_morning_message(context: ContextTypes.DEFAULT_TYPE = None) -> None:
     """Отправка утреннего сообщения"""
     try:
@@ -418,36 +2465,10 @@ async def send_morning_message(context: ContextTypes.DEFAULT_TYPE = None) -> Non
             logger.error("Chat ID не найден")
             return
 
-        moscow_weather = await get_weather("Moscow")
-        podolsk_weather = await get_weather("Podolsk")
-        
-        message = f"🌅 Доброе утро! Пусть этот день будет замечательным! ✨\n\n"
-        message += f"🌤 Погода сегодня:\n🏙 {moscow_weather}\n🌆 {podolsk_weather}\n\n"
-        message += f"💫 Вдохновляющая цитата дня:\n✨ {random.choice(motivational_quotes)} ✨\n\n"
-        
-        weekday = datetime.now().strftime('%A')
-        if weekday in schedule_dict:
-            message += "📚 Расписание на сегодня:\n\n"
-            for time, lesson in schedule_dict[weekday]:
-                message += f"⏰ {time} - 📖 {lesson}\n"
-            message += "\n🎯 Удачного учебного дня! 🌟"
-        else:
-            message += "🎉 Сегодня выходной! Отличного отдыха! ✨"
-        
-        image_path = get_random_image()
-        if image_path:
-            await context.bot.send_photo(
-                chat_id=context._chat_id,
-                photo=open(image_path, 'rb'),
-                caption=message
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=context._chat_id,
-                text=message
-            )
+        message = await build_morning_message(schedules.for_chat(context._chat_id))
+        await deliver_morning_message(context.bot, context._chat_id, message, await get_random_image())
     except Exception as e:
-        logger.error(f"Ошибка при отправке утреннего сообщения: {e}")
+        logger.error("Ошибка при отправке утреннего сообщения: %s", e)
 
 async def send_lesson_notification(context: ContextTypes.DEFAULT_TYPE = None) -> None:
     """Отправка уведомления перед уроком"""
@@ -456,58 +2477,205 @@ async def send_lesson_notification(context: ContextTypes.DEFAULT_TYPE = None) ->
             logger.error("Chat ID не найден")
             return
 
-        weekday = datetime.now().strftime('%A')
-        current_time = datetime.now().strftime('%H:%M')
-        
-        if weekday in schedule_dict:
-            for time, lesson in schedule_dict[weekday]:
-                lesson_time = datetime.strptime(time, '%H:%M').time()
-                notification_time = (lesson_time - timedelta(minutes=5)).strftime('%H:%M')
-                
-                if current_time == notification_time:
-                    message = f"⏰ Через 5 минут начинается урок!\n\n📚 {lesson}\n⏱ Начало в {time}"
-                    await context.bot.send_message(
-                        chat_id=context._chat_id,
-                        text=message
-                    )
+        timetable = schedules.for_chat(context._chat_id).timetable
+        lesson = timetable.starting_at(moscow_now() + timedelta(minutes=REMINDER_MINUTES))
+        if lesson:
+            message = f"⏰ Через {REMINDER_MINUTES} минут начинается урок!\n\n📚 {lesson.subject}\n⏱ Начало в {lesson.time}"
+            await context.bot.send_message(
+                chat_id=context._chat_id,
+                text=message
+            )
     except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления о уроке: {e}")
+        logger.error("Ошибка при отправке уведомления о уроке: %s", e)
 
-class ChatIdStore:
-    def __init__(self):
-        self.chat_ids = set()
-        self.filename = 'chat_ids.txt'
-        self.load_chat_ids()
+class RenderCache:
+    """Готовые тексты ответов одной версии расписания класса; запросы /find вытесняются по LRU.
+    При перезагрузке расписания класс получает новый пустой кэш."""
+    def __init__(self, max_queries: int = 256):
+        self.max_queries = max_queries
+        self.entries = {}
+        self.queries = OrderedDict()
 
-    def add_chat_id(self, chat_id):
-        self.chat_ids.add(chat_id)
-        self.save_chat_ids()
+    def get(self, key, render):
+        if key not in self.entries:
+            self.entries[key] = render()
+        return self.entries[key]
 
-    def get_chat_ids(self):
-        return self.chat_ids
+    def get_daily(self, key, day, render):
+        """Текст, меняющийся раз в день: хранится только значение за последнюю дату"""
+        cached = self.entries.get(key)
+        if cached is None or cached[0] != day:
+            cached = self.entries[key] = (day, render())
+        return cached[1]
 
-    def load_chat_ids(self):
-        try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r') as f:
-                    self.chat_ids = set(int(line.strip()) for line in f if line.strip())
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке chat_ids: {e}")
+    def get_query(self, query: str, render):
+        if query in self.queries:
+            self.queries.move_to_end(query)
+            return self.queries[query]
+        result = self.queries[query] = render()
+        if len(self.queries) > self.max_queries:
+            self.queries.popitem(last=False)
+        return result
 
-    def save_chat_ids(self):
-        try:
-            with open(self.filename, 'w') as f:
-                for chat_id in self.chat_ids:
-                    f.write(f"{chat_id}\n")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении chat_ids: {e}")
+def render_day(class_schedule: ClassSchedule, weekday: str) -> str:
+    lines = ["🎯 Расписание уроков:\n"]
+    if weekday in class_schedule.schedule:
+        lines.append(f"📅 День: {weekday}\n")
+        lines.extend(f"⏰ {time} - 📚 {lesson}" for time, lesson in class_schedule.schedule[weekday])
+    else:
+        lines.append("🌟 Сегодня выходной день! Отдыхаем! 🎉")
+    return "\n".join(lines) + "\n"
+
+def render_week(class_schedule: ClassSchedule) -> List[str]:
+    lines = ["🗓 Расписание на неделю:\n"]
+    for day, lessons in class_schedule.schedule.items():
+        lines.append(f"✨ {day}")
+        lines.extend(f"⏰ {time} - 📚 {subject}" for time, subject in lessons)
+        lines.append("")
+    return split_text("\n".join(lines) + "\n")
+
+def render_stats(class_schedule: ClassSchedule) -> str:
+    subject_count = {}
+    for lesson in class_schedule.timetable.lessons:
+        subject_count[lesson.subject] = subject_count.get(lesson.subject, 0) + 1
+    total_lessons = sum(subject_count.values())
+    
+    sorted_subjects = sorted(subject_count.items(), key=lambda x: x[1], reverse=True)
+    
+    parts = ["✨ Статистика по предметам ✨\n\n"]
+    for subject, count in sorted_subjects:
+        percentage = (count / total_lessons) * 100
+        parts.append(f"📚 {subject}:\n   {count} уроков ({percentage:.1f}%) {'🌟' * (count // 2)}\n\n")
+    parts.append(f"🎯 Всего {total_lessons} уроков в неделю! 🎉")
+    return "".join(parts)
+
+def render_find(class_schedule: ClassSchedule, search_term: str) -> str:
+    timetable = class_schedule.timetable
+    matches = timetable.subjects.search(search_term, limit=len(timetable.subjects.names))
+    subjects = {name for name, score in matches if score >= SUBJECT_MATCH_SCORE}
+    found_lessons = [
+        (lesson.day, lesson.time, lesson.subject)
+        for lesson in timetable.lessons
+        if lesson.subject in subjects
+    ]
+    
+    if not found_lessons:
+        message = f"❌ По запросу '{search_term}' ничего не найдено\n\n"
+        if matches:
+            return message + "💡 Возможно, ты имел в виду:\n" + "\n".join(f"• {name}" for name, _ in matches[:3])
+        return message + "💡 Попробуй другой запрос!"
+    parts = [f"🔍 Результаты поиска '{search_term}':\n\n"]
+    parts.extend(f"📅 {day}\n⏰ {time} - 📚 {subject}\n\n" for day, time, subject in found_lessons)
+    parts.append("✨ Удачи в учебе! 🌟")
+    return "".join(parts)
+
+def render_morning_body(class_schedule: ClassSchedule, weekday: str) -> str:
+    """Цитата дня и расписание для утреннего сообщения"""
+    parts = [f"💫 Вдохновляющая цитата дня:\n✨ {random.choice(motivational_quotes)} ✨\n\n"]
+    if weekday in class_schedule.schedule:
+        parts.append("📚 Расписание на сегодня:\n\n")
+        parts.extend(f"⏰ {time} - 📖 {lesson}\n" for time, lesson in class_schedule.schedule[weekday])
+        parts.append("\n🎯 Удачного учебного дня! 🌟")
+    else:
+        parts.append("🎉 Сегодня выходной! Отличного отдыха! ✨")
+    return "".join(parts)
+
+DAY_ALIASES = {
+    'monday': 'Monday', 'понедельник': 'Monday', 'пн': 'Monday',
+    'tuesday': 'Tuesday', 'вторник': 'Tuesday', 'вт': 'Tuesday',
+    'wednesday': 'Wednesday', 'среда': 'Wednesday', 'ср': 'Wednesday',
+    'thursday': 'Thursday', 'четверг': 'Thursday', 'чт': 'Thursday',
+    'friday': 'Friday', 'пятница': 'Friday', 'пт': 'Friday',
+    'saturday': 'Saturday', 'суббота': 'Saturday', 'сб': 'Saturday',
+    'sunday': 'Sunday', 'воскресенье': 'Sunday', 'вс': 'Sunday',
+}
+WEEK_ALIASES = {'week', 'неделя'}
+NEXT_ALIASES = {'next', 'следующий', 'дальше'}
+RELATIVE_DAY_ALIASES = {'today': 0, 'сегодня': 0, 'tomorrow': 1, 'завтра': 1}
+
+def inline_article(result_id: str, title: str, description: str, text: str) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description=description[:100],
+        input_message_content=InputTextMessageContent(text[:MAX_MESSAGE_LENGTH])
+    )
+
+class InlineIndex:
+    """Готовые результаты inline-запросов по расписанию класса: дни, неделя и предметы.
+    Строится один раз на версию расписания и хранится в его RenderCache."""
+    def __init__(self, class_schedule: ClassSchedule):
+        self.class_schedule = class_schedule
+        self.days = {
+            weekday: inline_article(
+                f"day:{weekday}", f"📅 {weekday}", ', '.join(subject for _, subject in lessons),
+                render_day(class_schedule, weekday)
+            )
+            for weekday, lessons in class_schedule.schedule.items()
+        }
+        self.week = inline_article(
+            "week", "🗓 Расписание на неделю", f"Класс {class_schedule.class_id}", render_week(class_schedule)[0]
+        )
+        timetable = class_schedule.timetable
+        self.subjects = {
+            name: inline_article(
+                f"subject:{position}", f"📚 {name}",
+                ', '.join(f"{lesson.day[:3]} {lesson.time}" for lesson in timetable.lessons if lesson.subject == name),
+                render_find(class_schedule, name)
+            )
+            for position, name in enumerate(timetable.subjects.names)
+        }
+
+    def day(self, weekday: str) -> InlineQueryResultArticle:
+        return self.days.get(weekday) or inline_article(
+            f"day:{weekday}", f"📅 {weekday}", "Выходной",
+            f"📅 {weekday}\n\n🎊 Уроков нет, выходной день! ✨"
+        )
+
+    def next(self, moment: datetime) -> InlineQueryResultArticle:
+        """Следующий урок зависит от времени, поэтому не кэшируется"""
+        timetable = self.class_schedule.timetable
+        lesson = timetable.next(moment)
+        if lesson is None:
+            return inline_article("next", "🌟 Уроков больше нет", "На сегодня все", "🌟 На сегодня уроков больше нет!")
+        return inline_article(
+            "next", f"🎯 Следующий урок: {lesson.subject}", f"Начало в {lesson.time}",
+            f"🎯 Следующий урок:\n\n📚 Предмет: {lesson.subject}\n⏰ Начало в {lesson.time}\n"
+            f"⏳ До начала: {format_duration(timetable.seconds_until(lesson.start, moment))}"
+        )
 
-chat_id_store = ChatIdStore()
+    def search(self, text: str) -> List[InlineQueryResultArticle]:
+        """Дни, чьи названия начинаются с запроса, и предметы по поиску с опечатками"""
+        weekdays = dict.fromkeys(weekday for alias, weekday in DAY_ALIASES.items() if alias.startswith(text))
+        subjects = self.class_schedule.timetable.subjects.search(text, limit=len(self.subjects))
+        return [self.day(weekday) for weekday in weekdays] + [self.subjects[name] for name, _ in subjects]
+
+def inline_results(query: str) -> tuple:
+    """(результаты, cache_time) для текста inline-запроса; первым словом можно указать класс"""
+    tokens = query.split()
+    class_id = schedules.find(tokens[0]) if tokens else None
+    if class_id is not None:
+        tokens = tokens[1:]
+    class_schedule = schedules.get(class_id or DEFAULT_CLASS)
+    index = class_schedule.render_cache.get('inline', lambda: InlineIndex(class_schedule))
+    text = normalize_subject(' '.join(tokens))
+
+    if not text:
+        return [*index.days.values(), index.week], INLINE_CACHE_TIME
+    if text in WEEK_ALIASES:
+        return [index.week], INLINE_CACHE_TIME
+    if text in DAY_ALIASES:
+        return [index.day(DAY_ALIASES[text])], INLINE_CACHE_TIME
+    if text in NEXT_ALIASES:
+        return [index.next(moscow_now())], INLINE_LIVE_CACHE_TIME
+    if text in RELATIVE_DAY_ALIASES:
+        day = moscow_now() + timedelta(days=RELATIVE_DAY_ALIASES[text])
+        return [index.day(day.strftime('%A'))], INLINE_LIVE_CACHE_TIME
+    return index.search(text), INLINE_CACHE_TIME
 
 async def show_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать расписание на сегодня или указанный день"""
-    weekday = datetime.now().strftime('%A')
-    message = "🎯 Расписание уроков:\n\n"
+    weekday = moscow_now().strftime('%A')
     
     if len(context.args) > 0:
         day = context.args[0].capitalize()
@@ -524,31 +2692,16 @@ async def show_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             )
             return
     
-    if weekday in schedule_dict:
-        message += f"📅 День: {weekday}\n\n"
-        for time, lesson in schedule_dict[weekday]:
-            message += f"⏰ {time} - 📚 {lesson}\n"
-    else:
-        message += "🌟 Сегодня выходной день! Отдыхаем! 🎉"
-    
-    await update.message.reply_text(message)
+    class_schedule = schedules.for_chat(update.effective_chat.id)
+    await update.message.reply_text(
+        class_schedule.render_cache.get(('day', weekday), lambda: render_day(class_schedule, weekday))
+    )
 
 async def week_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает расписание на всю неделю"""
-    message = "🗓 Расписание на неделю:\n\n"
-    
-    for day, lessons in schedule_dict.items():
-        message += f"✨ {day}\n"
-        for time, subject in lessons:
-            message += f"⏰ {time} - 📚 {subject}\n"
-        message += "\n"
-    
-    if len(message) > 4096:
-        parts = [message[i:i+4096] for i in range(0, len(message), 4096)]
-        for part in parts:
-            await update.message.reply_text(part)
-    else:
-        await update.message.reply_text(message)
+    class_schedule = schedules.for_chat(update.effective_chat.id)
+    for part in class_schedule.render_cache.get('week', lambda: render_week(class_schedule)):
+        await update.message.reply_text(part)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
@@ -565,6 +2718,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "• /next - информация о следующем уроке\n"
             "• /find предмет - найти уроки по предмету\n"
             "• /stats - статистика по предметам\n"
+            "• /class - выбрать класс для расписания и уведомлений\n"
             "• /homework - показать домашнее задание\n"
             "• /homework_add - добавить домашнее задание\n"
             "• /homework_del - удалить домашнее задание\n\n"
@@ -574,12 +2728,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "👨‍💼 Команды администратора:\n"
             "• /add_answer предмет - добавить ответы для предмета\n"
             "• /del_answer предмет - удалить ответы для предмета\n"
+            "• /perf - метрики производительности\n"
         )
         
         await update.message.reply_text(message)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка в команде start: {e}")
+        logger.error("❌ Ошибка в команде start: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при выполнении команды")
 
 async def test_morning(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -590,22 +2745,18 @@ async def test_morning(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def test_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Тестовая команда для проверки уведомления об уроке"""
     context._chat_id = update.effective_chat.id
-    current_time = datetime.now()
-    next_lesson = None
+    class_schedule = schedules.for_chat(context._chat_id)
+    current_time = moscow_now()
     weekday = current_time.strftime('%A')
     
-    if weekday in schedule_dict:
-        for time, lesson in schedule_dict[weekday]:
-            lesson_time = datetime.strptime(time, '%H:%M').time()
-            if lesson_time > current_time.time():
-                next_lesson = (time, lesson)
-                break
+    if weekday in class_schedule.schedule:
+        next_lesson = class_schedule.timetable.next(current_time)
         
         if next_lesson:
             message = (
-                f"⏰ Внимание! Через 10 минут начинается урок!\n\n"
-                f"📚 Предмет: {next_lesson[1]}\n"
-                f"⏱ Начало в {next_lesson[0]}\n\n"
+                f"⏰ Внимание! Через {REMINDER_MINUTES} минут начинается урок!\n\n"
+                f"📚 Предмет: {next_lesson.subject}\n"
+                f"⏱ Начало в {next_lesson.time}\n\n"
                 f"✨ Желаю успешного урока! 🌟"
             )
             await context.bot.send_message(
@@ -625,29 +2776,22 @@ async def test_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 async def next_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает информацию о следующем уроке"""
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    current_time = datetime.now(moscow_tz)
+    class_schedule = schedules.for_chat(update.effective_chat.id)
+    current_time = moscow_now()
     weekday = current_time.strftime('%A')
     
-    if weekday in schedule_dict:
-        next_lesson_info = None
-        for time, lesson in schedule_dict[weekday]:
-            lesson_time = datetime.strptime(time, '%H:%M').time()
-            if lesson_time > current_time.time():
-                next_lesson_info = (time, lesson)
-                break
+    if weekday in class_schedule.schedule:
+        timetable = class_schedule.timetable
+        next_lesson_info = timetable.next(current_time)
         
         if next_lesson_info:
-            lesson_time = datetime.strptime(next_lesson_info[0], '%H:%M')
-            time_until = lesson_time - current_time.replace(microsecond=0)
-            hours, remainder = divmod(time_until.seconds, 3600)
-            minutes, _ = divmod(remainder, 60)
+            time_until = timetable.seconds_until(next_lesson_info.start, current_time)
             
             message = (
                 f"🎯 Следующий урок:\n\n"
-                f"📚 Предмет: {next_lesson_info[1]}\n"
-                f"⏰ Начало в {next_lesson_info[0]}\n"
-                f"⏳ До начала: {hours} ч. {minutes} мин.\n"
+                f"📚 Предмет: {next_lesson_info.subject}\n"
+                f"⏰ Начало в {next_lesson_info.time}\n"
+                f"⏳ До начала: {format_duration(time_until)}\n"
                 f"💫 Удачи на уроке! ✨"
             )
         else:
@@ -657,122 +2801,240 @@ async def next_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     
     await update.message.reply_text(message)
 
-def is_bot_running():
-    """Проверка, запущен ли уже экземпляр бота"""
-    pid_file = "bot.pid"
-    try:
-        if os.path.exists(pid_file):
-            file_age = time.time() - os.path.getmtime(pid_file)
-            if file_age > 300:  
-                os.remove(pid_file)
-                logger.info("Удален устаревший PID файл")
-                return False
-            
-            try:
-                with open(pid_file, 'r') as f:
-                    old_pid = int(f.read().strip())
-                    os.remove(pid_file)
-                    logger.info("Удален существующий PID файл")
-                    return False
-            except (ValueError, IOError) as e:
-                logger.error(f"Ошибка при чтении PID файла: {e}")
-                os.remove(pid_file)
-                return False
-        
-        with open(pid_file, 'w') as f:
-            f.write(str(os.getpid()))
-        return False
-    except Exception as e:
-        logger.error(f"Ошибка при проверке запущенных экземпляров: {e}")
-        return False
+async def current_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает информацию о текущем уроке"""
+    class_schedule = schedules.for_chat(update.effective_chat.id)
+    current_time = moscow_now()
+    timetable = class_schedule.timetable
+    lesson = timetable.current(current_time)
+    
+    if lesson:
+        message = (
+            f"📖 Сейчас идет {lesson.number}-й урок:\n\n"
+            f"📚 Предмет: {lesson.subject}\n"
+            f"⏰ Начало в {lesson.time}\n"
+            f"⏳ До конца: {format_duration(timetable.seconds_until(lesson.end, current_time))}\n"
+            f"💫 Не отвлекайся! ✨"
+        )
+    elif timetable.current_break(current_time):
+        message = "☕️ Сейчас перемена!\n\n💡 Подробнее: /break"
+    elif current_time.strftime('%A') in class_schedule.schedule:
+        message = "🌟 Сейчас уроков нет!\n\n💡 Следующий урок: /next"
+    else:
+        message = "🎊 Сегодня выходной день!\n\n✨ Наслаждайся отдыхом! 🌟"
+    
+    await update.message.reply_text(message)
+
+async def break_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает информацию о текущей перемене"""
+    current_time = moscow_now()
+    timetable = schedules.for_chat(update.effective_chat.id).timetable
+    lesson = timetable.current_break(current_time)
+    
+    if lesson:
+        message = (
+            f"☕️ Сейчас перемена!\n\n"
+            f"⏳ До конца перемены: {format_duration(timetable.seconds_until(lesson.start, current_time))}\n"
+            f"📚 Следующий урок: {lesson.subject}\n"
+            f"⏰ Начало в {lesson.time}"
+        )
+    elif timetable.current(current_time):
+        message = "📖 Сейчас идет урок, перемена еще не началась!\n\n💡 Подробнее: /current"
+    else:
+        message = "🌟 Сейчас не перемена!\n\n💡 Следующий урок: /next"
+    
+    await update.message.reply_text(message)
+
+class LeaderLock:
+    """Эксклюзивная блокировка файла: опрос и рассылки ведет только один процесс"""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.fd = None
+
+    def acquire(self):
+        """Захват блокировки; пока она у другого процесса, ждем в режиме ожидания"""
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            owner = os.pread(self.fd, 32, 0).decode(errors='ignore').strip()
+            logger.warning("Бот уже запущен (PID %s), ожидание освобождения блокировки...", owner or '?')
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, str(os.getpid()).encode(), 0)
+        logger.info("Блокировка %s получена, процесс %s - ведущий", self.filename, os.getpid())
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            os.ftruncate(self.fd, 0)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            logger.info("Блокировка освобождена при завершении работы")
+        except Exception as e:
+            logger.error("Ошибка при освобождении блокировки: %s", e)
+        self.fd = None
+
+leader_lock = LeaderLock(LOCK_FILE)
 
 def cleanup():
-    """Очистка PID файла при завершении"""
+    """Запись несохраненных данных и освобождение блокировки при завершении"""
+    sharded_broadcaster.shutdown()
+    persistence.close()
+    leader_lock.release()
+
+def morning_slot(class_id: str) -> str:
+    return f"morning:{class_id}"
+
+def lesson_slot(class_id: str, lesson: Lesson) -> str:
+    return f"lesson:{class_id}:{lesson.day}:{lesson.number}"
+
+async def enqueue_morning(class_schedule: ClassSchedule, today: datetime, image_path: Optional[str]) -> None:
+    """Утреннее сообщение класса ставится в журнал один раз за день"""
+    slot, day = morning_slot(class_schedule.class_id), today.date().isoformat()
+    # После перезапуска доставляется уже сохраненный в журнале текст, без новой цитаты и погоды
+    if outbox.message(slot, day) is None:
+        expires_at = today.replace(hour=MORNING_TIME[0], minute=MORNING_TIME[1], second=0, microsecond=0)
+        expires_at += timedelta(minutes=MORNING_GRACE_MINUTES)
+        message = await build_morning_message(class_schedule)
+        await outbox.enqueue(slot, day, message, expires_at.timestamp(), image_path, class_schedule.class_id)
+
+async def send_morning_broadcast(application: Application) -> None:
+    """Утренняя рассылка через журнал доставки: по одному сообщению на класс"""
     try:
-        pid_file = "bot.pid"
-        if os.path.exists(pid_file):
-            os.remove(pid_file)
-            logger.info("PID файл успешно удален при завершении работы")
+        logger.info("Отправка утреннего сообщения...")
+        await store_loader.wait('images')
+        today = moscow_now()
+        day = today.date().isoformat()
+        class_schedules = schedules.all()
+        image_path = await get_random_image()
+        for class_schedule in class_schedules:
+            await enqueue_morning(class_schedule, today, image_path)
+        await asyncio.gather(*(
+            outbox.drain(application.bot, morning_slot(class_schedule.class_id), day)
+            for class_schedule in class_schedules
+        ))
     except Exception as e:
-        logger.error(f"Ошибка при удалении PID файла: {e}")
+        logger.error("Ошибка при утренней рассылке: %s", e)
 
-async def send_scheduled_message(application: Application) -> None:
-    """Обертка для отправки запланированных сообщений"""
+async def send_lesson_reminder(application: Application, class_schedule: ClassSchedule, lesson: Lesson) -> None:
+    """Рассылка напоминания о начале урока чатам класса через журнал доставки"""
     try:
-        moscow_tz = pytz.timezone('Europe/Moscow')
-        current_time = datetime.now(moscow_tz)
-        weekday = current_time.strftime('%A')
-        
-        logger.info(f"Проверка расписания: {current_time.strftime('%H:%M')} {weekday}")
-        
-        
-        notification_times = {
-            (8, 20): (0, "8:30"),    # Первый урок
-            (9, 15): (1, "9:25"),    # Второй урок
-            (10, 20): (2, "10:30"),  # Третий урок
-            (11, 15): (3, "11:25"),  # Четвертый урок
-            (12, 10): (4, "12:20"),  # Пятый урок
-            (13, 5): (5, "13:15"),   # Шестой урок
-            (14, 10): (6, "14:20")   # Седьмой урок
-        }
-        
-        if current_time.hour == 7 and current_time.minute == 30:
-            logger.info("Отправка утреннего сообщения...")
-            for chat_id in chat_id_store.get_chat_ids():
-                try:
-                    context = ContextTypes.DEFAULT_TYPE(application=application)
-                    context._chat_id = chat_id
-                    await send_morning_message(context)
-                    logger.info(f"Утреннее сообщение отправлено для chat_id {chat_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке утреннего сообщения для chat_id {chat_id}: {e}")
-        
-        current_time_tuple = (current_time.hour, current_time.minute)
-        if current_time_tuple in notification_times and weekday in schedule_dict:
-            lesson_index, start_time = notification_times[current_time_tuple]
-            if lesson_index < len(schedule_dict[weekday]):
-                time, lesson = schedule_dict[weekday][lesson_index]
-                logger.info(f"Отправка уведомления о уроке {lesson} ({weekday}, {time})")
-                
-                for chat_id in chat_id_store.get_chat_ids():
-                    try:
-                        message = (
-                            f"⏰ Через 10 минут начинается {lesson_index + 1}-й урок!\n\n"
-                            f"📅 {weekday}\n"
-                            f"📚 Предмет: {lesson}\n"
-                            f"⏱ Начало в {time}\n"
-                            f"💫 Удачи на уроке! ✨"
-                        )
-                        await application.bot.send_message(
-                            chat_id=chat_id,
-                            text=message
-                        )
-                        logger.info(f"Уведомление о уроке отправлено для chat_id {chat_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке уведомления об уроке для chat_id {chat_id}: {e}")
-    
+        logger.info("Отправка уведомления о уроке %s (%s, %s, %s)",
+                    lesson.subject, class_schedule.class_id, lesson.day, lesson.time)
+        message = (
+            f"⏰ Через {REMINDER_MINUTES} минут начинается {lesson.number}-й урок!\n\n"
+            f"📅 {lesson.day}\n"
+            f"📚 Предмет: {lesson.subject}\n"
+            f"⏱ Начало в {lesson.time}\n"
+            f"💫 Удачи на уроке! ✨"
+        )
+        hours, minutes = divmod(lesson.start % MINUTES_PER_DAY, 60)
+        starts_at = (moscow_now() + timedelta(minutes=REMINDER_MINUTES)).replace(
+            hour=hours, minute=minutes, second=0, microsecond=0
+        )
+        slot, day = lesson_slot(class_schedule.class_id, lesson), starts_at.date().isoformat()
+        await outbox.enqueue(slot, day, message, starts_at.timestamp(), class_id=class_schedule.class_id)
+        await outbox.drain(application.bot, slot, day)
     except Exception as e:
-        logger.error(f"Ошибка в send_scheduled_message: {e}")
+        logger.error("Ошибка при отправке уведомления о уроке: %s", e)
+
+async def send_lesson_reminders(application: Application, fire_at: int) -> None:
+    """Напоминания всех классов, у которых урок начинается в одну и ту же минуту недели"""
+    start = (fire_at + REMINDER_MINUTES) % MINUTES_PER_WEEK
+    await asyncio.gather(*(
+        send_lesson_reminder(application, class_schedule, class_schedule.timetable.by_start[start])
+        for class_schedule in schedules.all() if start in class_schedule.timetable.by_start
+    ))
+
+class ReminderScheduler:
+    """Задачи APScheduler, построенные по скомпилированным расписаниям классов.
+    Одна задача на минуту срабатывания, сколько бы классов на нее ни приходилось."""
+    def __init__(self, scheduler: AsyncIOScheduler, application: Application):
+        self.scheduler = scheduler
+        self.application = application
+        self.job_ids = set()
+        self.version = None
+        self.tasks = set()
+
+    def _add_job(self, job_id: str, func, args: list, grace_minutes: int, **trigger):
+        self.scheduler.add_job(
+            func,
+            'cron',
+            id=job_id,
+            args=args,
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True,
+            misfire_grace_time=grace_minutes * 60,
+            **trigger
+        )
+
+    def _run_now(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def catch_up(self, registry: ScheduleRegistry, now: datetime) -> None:
+        """После перезапуска: продолжает прерванные рассылки и запускает пропущенные, пока не истек их срок"""
+        for slot, date in outbox.unfinished(now.timestamp()):
+            logger.info("Продолжение прерванной рассылки %s %s", slot, date)
+            self._run_now(outbox.drain(self.application.bot, slot, date))
+
+        today = now.date().isoformat()
+        class_schedules = registry.all()
+        morning_delay = now.hour * 60 + now.minute - (MORNING_TIME[0] * 60 + MORNING_TIME[1])
+        if 0 <= morning_delay < MORNING_GRACE_MINUTES and any(
+            outbox.message(morning_slot(class_schedule.class_id), today) is None for class_schedule in class_schedules
+        ):
+            logger.info("Пропущена утренняя рассылка, отправка с опозданием %d мин.", morning_delay)
+            self._run_now(send_morning_broadcast(self.application))
+
+        minute = minute_of_week(now)
+        for class_schedule in class_schedules:
+            for lesson in class_schedule.timetable.lessons:
+                fire_at = (lesson.start - REMINDER_MINUTES) % MINUTES_PER_WEEK
+                if ((minute - fire_at) % MINUTES_PER_WEEK < REMINDER_MINUTES
+                        and outbox.message(lesson_slot(class_schedule.class_id, lesson), today) is None):
+                    logger.info("Пропущено напоминание об уроке %s (%s), отправка с опозданием",
+                                lesson.subject, class_schedule.class_id)
+                    self._run_now(send_lesson_reminder(self.application, class_schedule, lesson))
+
+    def sync(self, registry: ScheduleRegistry) -> None:
+        """Пересоздает задачи, если расписание какого-либо класса изменилось"""
+        if registry.version == self.version:
+            return
+
+        job_ids = {'morning'}
+        self._add_job('morning', send_morning_broadcast, [self.application], MORNING_GRACE_MINUTES,
+                      hour=MORNING_TIME[0], minute=MORNING_TIME[1])
+
+        fire_minutes = {
+            (lesson.start - REMINDER_MINUTES) % MINUTES_PER_WEEK
+            for class_schedule in registry.classes.values()
+            for lesson in class_schedule.timetable.lessons
+        }
+        for fire_at in fire_minutes:
+            day, minute_of_day = divmod(fire_at, MINUTES_PER_DAY)
+            job_id = f"reminder:{fire_at}"
+            job_ids.add(job_id)
+            self._add_job(job_id, send_lesson_reminders, [self.application, fire_at], REMINDER_MINUTES,
+                          day_of_week=day, hour=minute_of_day // 60, minute=minute_of_day % 60)
+
+        for job_id in self.job_ids - job_ids:
+            self.scheduler.remove_job(job_id)
+        self.job_ids = job_ids
+        self.version = registry.version
+        logger.info("Запланировано задач рассылки: %d (классов %d, версия расписаний %s)",
+                    len(job_ids), len(registry.classes), registry.version)
+
+reminder_scheduler: Optional[ReminderScheduler] = None
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает статистику по предметам"""
-    subject_count = {}
-    total_lessons = 0
-    
-    for day, lessons in schedule_dict.items():
-        for _, subject in lessons:
-            subject_count[subject] = subject_count.get(subject, 0) + 1
-            total_lessons += 1
-    
-    sorted_subjects = sorted(subject_count.items(), key=lambda x: x[1], reverse=True)
-    
-    message = "✨ Статистика по предметам ✨\n\n"
-    for subject, count in sorted_subjects:
-        percentage = (count / total_lessons) * 100
-        message += f"📚 {subject}:\n   {count} уроков ({percentage:.1f}%) {'🌟' * (count // 2)}\n\n"
-    
-    message += f"🎯 Всего {total_lessons} уроков в неделю! 🎉"
-    await update.message.reply_text(message)
+    class_schedule = schedules.for_chat(update.effective_chat.id)
+    await update.message.reply_text(class_schedule.render_cache.get('stats', lambda: render_stats(class_schedule)))
 
 async def find_subject(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Поиск уроков по предмету"""
@@ -786,102 +3048,343 @@ async def find_subject(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     search_term = ' '.join(context.args).lower()
-    found_lessons = []
-    
-    for day, lessons in schedule_dict.items():
-        for time, subject in lessons:
-            if search_term in subject.lower():
-                found_lessons.append((day, time, subject))
-    
-    if found_lessons:
-        message = f"🔍 Результаты поиска '{search_term}':\n\n"
-        for day, time, subject in found_lessons:
-            message += f"📅 {day}\n⏰ {time} - 📚 {subject}\n\n"
-        message += "✨ Удачи в учебе! 🌟"
-    else:
-        message = f"❌ По запросу '{search_term}' ничего не найдено\n\n💡 Попробуй другой запрос!"
+    class_schedule = schedules.for_chat(update.effective_chat.id)
+    await update.message.reply_text(
+        class_schedule.render_cache.get_query(
+            normalize_subject(search_term), lambda: render_find(class_schedule, search_term)
+        )
+    )
+
+async def can_change_class(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """В личном чате класс меняет сам пользователь, в группе - администратор группы или бота"""
+    user_id = update.effective_user.id
+    if update.effective_chat.type == 'private' or user_id in ADMIN_IDS:
+        return True
+    try:
+        member = await context.bot.get_chat_member(update.effective_chat.id, user_id)
+    except Exception as e:
+        logger.error("Ошибка при проверке прав в чате %s: %s", update.effective_chat.id, e)
+        return False
+    return member.status in ('creator', 'administrator')
+
+async def choose_class(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Привязка чата к классу: расписание, напоминания и утренние сообщения будут для него"""
+    chat_id = update.effective_chat.id
+    available = ', '.join(sorted(class_schedule.class_id for class_schedule in schedules.all()))
+    if not context.args:
+        await update.message.reply_text(
+            f"🏫 Текущий класс: {schedules.for_chat(chat_id).class_id}\n\n"
+            f"📋 Доступные классы: {available}\n"
+            f"💡 Чтобы сменить класс, напиши: /class [название]"
+        )
+        return
     
-    await update.message.reply_text(message)
+    class_id = schedules.find(' '.join(context.args))
+    if class_id is None:
+        await update.message.reply_text(f"❌ Класс не найден\n\n📋 Доступные классы: {available}")
+        return
+    
+    if not await can_change_class(update, context):
+        await update.message.reply_text("⛔️ Сменить класс группы может только ее администратор")
+        return
+    
+    chat_registry.set_class(chat_id, class_id)
+    logger.info("Чат %s привязан к классу %s", chat_id, class_id)
+    await update.message.reply_text(f"✅ Класс {class_id} выбран! Расписание и уведомления будут для него ✨")
 
-async def ping_server() -> None:
-    """Функция для поддержания бота в активном состоянии"""
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Inline-запрос @бот вторник / next / физика: ответ из готовых результатов.
+    Ответ не зависит от пользователя, поэтому серверы Telegram кэшируют его для всех"""
+    query = update.inline_query
     try:
-        logger.info("🔄 Пинг для поддержания активности...")
+        results, cache_time = inline_results(query.query)
+        await query.answer(results[:INLINE_MAX_RESULTS], cache_time=cache_time, is_personal=False)
     except Exception as e:
-        logger.error(f"Ошибка при отправке пинга: {e}")
+        logger.error("❌ Ошибка в inline-запросе: %s", e)
+
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сводка метрик производительности (только для администратора)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Эта команда доступна только администратору")
+        return
+    
+    lines = ["📊 Производительность\n", "⏱ Команды (p50 / p95, вызовов):"]
+    for labels, histogram in metrics.histogram_rows('bot_command_seconds')[:10]:
+        lines.append(
+            f"• /{labels['command']}: {histogram.quantile(0.5) * 1000:.0f} / "
+            f"{histogram.quantile(0.95) * 1000:.0f} мс, {histogram.count}"
+        )
+    
+    errors = {labels['method']: value for labels, value in metrics.counter_rows('telegram_api_errors_total')}
+    lines.append("\n📡 Telegram API (вызовов / ошибок):")
+    for labels, value in metrics.counter_rows('telegram_api_requests_total')[:10]:
+        lines.append(f"• {labels['method']}: {value:.0f} / {errors.get(labels['method'], 0):.0f}")
+    
+    processor = context.application.update_processor
+    wait = metrics.histogram_rows('update_wait_seconds')
+    lines.append(
+        f"\n📥 Обновления: в очереди {processor.waiting}, в работе {processor.active}"
+        + (f", ожидание p95 {wait[0][1].quantile(0.95) * 1000:.0f} мс" if wait else "")
+    )
+    
+    report = broadcaster.last_report
+    if report:
+        lines.append(f"\n📨 {report.summary()}")
+    for title, name, label in (("🌤 Погода", 'weather_fetch_seconds', 'city'),
+                               ("💾 Запись на диск", 'persistence_write_seconds', 'store')):
+        rows = metrics.histogram_rows(name)
+        if rows:
+            lines.append(f"\n{title} (среднее, вызовов):")
+            for labels, histogram in rows:
+                lines.append(f"• {labels[label]}: {histogram.sum / histogram.count * 1000:.1f} мс, {histogram.count}")
+    
+    await update.message.reply_text("\n".join(lines))
+
+async def handle_metrics(request: 'web.Request') -> 'web.Response':
+    from aiohttp import web
+    return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+metrics_runner: Optional['web.AppRunner'] = None
+metrics_task: Optional[asyncio.Future] = None
+
+async def start_metrics_server() -> None:
+    """HTTP-эндпоинт /metrics в формате Prometheus на локальном порту"""
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    # aiohttp импортируется в фоне, пока бот уже принимает обновления
+    await store_loader.wait('aiohttp')
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    try:
+        await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logger.error("Не удалось запустить сервер метрик: %s", e)
+        return
+    logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+class WebhookServer:
+    """HTTP-сервер aiohttp: прием обновлений от Telegram и проверка состояния"""
+    def __init__(self, application: Application, port: int, path: str, secret: str):
+        from aiohttp import web
+        self.web = web
+        self.application = application
+        self.port = port
+        self.secret = secret
+        self.started = time.monotonic()
+        self.runner = None
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get('/health', self.handle_health)
+
+    async def handle_update(self, request: 'web.Request') -> 'web.Response':
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            return self.web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except Exception as e:
+            logger.warning("Некорректное обновление в webhook: %s", e)
+            return self.web.Response(status=400)
+        if update is None:
+            return self.web.Response(status=400)
+        await self.application.update_queue.put(update)
+        return self.web.Response()
+
+    async def handle_health(self, request: 'web.Request') -> 'web.Response':
+        return self.web.json_response({
+            'status': 'ok',
+            'uptime': round(time.monotonic() - self.started),
+            'pending_updates': self.application.update_queue.qsize(),
+            'queued_updates': self.application.update_processor.waiting
+        })
+
+    async def start(self):
+        self.runner = self.web.AppRunner(self.app)
+        await self.runner.setup()
+        await self.web.TCPSite(self.runner, '0.0.0.0', self.port).start()
+        logger.info("Webhook-сервер слушает порт %s", self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+scheduler: Optional[AsyncIOScheduler] = None
+
+def handle_sigterm(stop):
+    """SIGTERM: сначала на диск записываются отложенные изменения, затем бот останавливается"""
+    logger.info("Получен SIGTERM, сохранение данных перед остановкой...")
+    task = asyncio.ensure_future(persistence.flush())
+    task.add_done_callback(lambda _: stop())
+
+def stop_polling(application: Application):
+    """Остановка run_polling. До application.start() stop_running() ничего не делает,
+    поэтому тогда выходим через SystemExit, как встроенный обработчик сигналов PTB"""
+    if application.running:
+        application.stop_running()
+    else:
+        raise SystemExit
+
+async def on_startup(application: Application) -> None:
+    """Запуск планировщика и фоновой загрузки хранилищ внутри цикла событий бота"""
+    global scheduler, reminder_scheduler, metrics_task
+    startup_timer.mark('инициализация')
+    store_loader.start('answers', answers_store.load, answers_store.import_legacy)
+    store_loader.start('uploads', upload_sessions.load)
+    store_loader.start('homework', homework_store.load)
+    store_loader.start('images', image_catalog.refresh)
+    store_loader.start('aiohttp', import_aiohttp)
+    metrics_task = asyncio.ensure_future(start_metrics_server())
+    
+    if application.updater is not None:
+        # run_polling уже повесил на SIGTERM свою остановку; заменяем ее на остановку после записи
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, handle_sigterm, lambda: stop_polling(application)
+        )
+    scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+    
+    reminder_scheduler = ReminderScheduler(scheduler, application)
+    reminder_scheduler.sync(schedules)
+    
+    scheduler.add_job(
+        persistence.call,
+        'cron',
+        args=[answers_store.compact],
+        hour=3,
+        minute=0,
+        max_instances=1,
+        coalesce=True
+    )
+    scheduler.add_job(persistence.call, 'cron', args=[Outbox.prune], hour=3, minute=5, coalesce=True)
+    scheduler.add_job(persistence.call, 'cron', args=[HomeworkStore.prune], hour=3, minute=10, coalesce=True)
+    scheduler.add_job(expire_upload_sessions, 'interval', minutes=5, coalesce=True)
+    # Измененные файлы расписаний подхватываются и без обращений к боту
+    scheduler.add_job(refresh_schedules, 'interval', seconds=60, coalesce=True)
+    
+    scheduler.start()
+    reminder_scheduler.catch_up(schedules, moscow_now())
+    startup_timer.mark('планировщик')
+    startup_timer.report()
+
+async def on_shutdown(application: Application) -> None:
+    """Освобождение ресурсов при остановке бота"""
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
+    if metrics_task is not None:
+        metrics_task.cancel()
+    for task in list(background_broadcasts):
+        logger.warning("Фоновая рассылка прервана остановкой бота")
+        task.cancel()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await weather_service.close()
+    await persistence.flush()
+
+async def run_webhook(application: Application) -> None:
+    """Работа в режиме webhook вместо long polling"""
+    server = WebhookServer(application, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop_event.set)
+    loop.add_signal_handler(signal.SIGTERM, handle_sigterm, stop_event.set)
+    
+    try:
+        async with application:
+            await on_startup(application)
+            await application.start()
+            if WEBHOOK_URL:
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+            await server.start()
+            await stop_event.wait()
+            await server.stop()
+            await application.stop()
+    finally:
+        await on_shutdown(application)
 
 def main() -> None:
     """Основная функция запуска бота"""
     try:
-        load_answers()
-        load_chats()
-        is_bot_running()
+        if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+            # Без секрета любой, кто достучится до порта, может прислать обновление от имени администратора
+            raise RuntimeError("для режима webhook нужно задать WEBHOOK_SECRET")
+        startup_timer.mark('импорт')
+        leader_lock.acquire()
+        startup_timer.mark('блокировка')
+        # Чаты нужны почти каждому обработчику и читаются одним запросом; остальное грузится в фоне
+        chat_registry.load()
+        schedules.refresh(force=True)
+        startup_timer.mark('чаты и расписания')
         
-        application = (
+        builder = (
             Application.builder()
             .token(TELEGRAM_BOT_TOKEN)
-            .connect_timeout(30)
-            .read_timeout(30)
-            .write_timeout(30)
-            .build()
+            .request(InstrumentedRequest(
+                connection_pool_size=256, connect_timeout=30, read_timeout=30, write_timeout=30
+            ))
+            .get_updates_request(InstrumentedRequest(connect_timeout=30, read_timeout=30, write_timeout=30))
+            .concurrent_updates(ChatUpdateProcessor(UPDATE_CONCURRENCY))
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
         )
+        if BOT_MODE == 'webhook':
+            builder = builder.updater(None)
+        application = builder.build()
 
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("test_morning", test_morning))
-        application.add_handler(CommandHandler("test_lesson", test_lesson))
-        application.add_handler(CommandHandler("schedule", show_schedule))
-        application.add_handler(CommandHandler("week", week_schedule))
-        application.add_handler(CommandHandler("next", next_lesson))
-        application.add_handler(CommandHandler("stats", stats))
-        application.add_handler(CommandHandler("find", find_subject))
-        application.add_handler(CommandHandler("add_answer", add_answer))
-        application.add_handler(CommandHandler("get_answer", get_answer))
-        application.add_handler(CommandHandler("list_answer", list_answers))
-        application.add_handler(CommandHandler("del_answer", del_answer))
-        application.add_handler(CommandHandler("done", handle_done))
+        application.add_handler(TypeHandler(Update, command_throttle), group=-1)
+        
+        for command, callback in (
+            ("start", start),
+            ("test_morning", test_morning),
+            ("test_lesson", test_lesson),
+            ("schedule", show_schedule),
+            ("week", week_schedule),
+            ("next", next_lesson),
+            ("current", current_lesson),
+            ("break", break_info),
+            ("stats", stats),
+            ("find", find_subject),
+            ("class", choose_class),
+            ("homework", homework),
+            ("homework_add", homework_add),
+            ("homework_del", homework_del),
+            ("add_answer", add_answer),
+            ("get_answer", get_answer),
+            ("list_answer", list_answers),
+            ("del_answer", del_answer),
+            ("done", handle_done),
+            ("perf", perf),
+        ):
+            application.add_handler(CommandHandler(command, timed_command(command, callback)))
 
+        application.add_handler(InlineQueryHandler(timed_command("inline", inline_query)))
         application.add_handler(MessageHandler(
             (filters.TEXT | filters.PHOTO) & ~filters.COMMAND,
-            handle_answer_input,
-            block=False
+            handle_answer_input
         ))
+        startup_timer.mark('сборка приложения')
 
-        scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+        logger.info("✨ Бот запущен и готов к работе! Режим: %s. Текущее время МСК: %s", BOT_MODE, moscow_now().strftime('%H:%M:%S'))
         
-        scheduler.add_job(
-            send_scheduled_message,
-            'cron',
-            minute='*',
-            args=[application],
-            max_instances=1,
-            coalesce=True,
-            misfire_grace_time=None
-        )
-        
-        scheduler.add_job(
-            ping_server,
-            'interval',
-            minutes=5,
-            max_instances=1,
-            coalesce=True,
-            misfire_grace_time=None
-        )
-        
-        scheduler.start()
-
-        logger.info(f"✨ Бот запущен и готов к работе! Текущее время МСК: {datetime.now(pytz.timezone('Europe/Moscow')).strftime('%H:%M:%S')}")
-        
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
-        )
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка: {e}")
-        cleanup()
+        logger.error("❌ Критическая ошибка: %s", e)
         sys.exit(1)
 
 if __name__ == '__main__':
     try:
         main()
     finally:
-        cleanup() 
\ No newline at end of file
+        cleanup()